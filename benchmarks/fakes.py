@@ -0,0 +1,316 @@
+"""Local stand-ins for the services metadataproxy talks to.
+
+Starts, in one process:
+
+* a fake Docker Engine API on a unix socket, with N synthetic running
+  containers whose IPs are loopback addresses (127.100.0.0/16), so a load
+  generator can send requests from a container's IP by binding to it
+* a fake STS/IAM query API that answers AssumeRole and GetRole
+* a fake mesos agent /state, with tasks on 127.200.0.0/16
+* a fake EC2 metadata service, including IMDSv2 token issuing
+
+Usage:
+    python benchmarks/fakes.py --containers 300 --docker-socket /tmp/docker.sock
+"""
+# Import python libs
+import argparse
+import datetime
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs
+
+ACCOUNT_ID = '123456789012'
+
+
+def container_ip(i):
+    return '127.100.{0}.{1}'.format(i // 250, i % 250 + 1)
+
+
+def mesos_task_ip(i):
+    return '127.200.{0}.{1}'.format(i // 250, i % 250 + 1)
+
+
+def role_name(i, roles):
+    return 'bench-role-{0}'.format(i % roles)
+
+
+def make_containers(count, roles, with_account=True):
+    containers = {}
+    for i in range(count):
+        container_id = '{0:064x}'.format(i + 1)
+        role = role_name(i, roles)
+        if with_account:
+            role = '{0}@{1}'.format(role, ACCOUNT_ID)
+        containers[container_id] = {
+            'Id': container_id,
+            'State': {'Running': True},
+            'Config': {
+                'Env': ['PATH=/usr/bin', 'IAM_ROLE={0}'.format(role), 'APP=bench{0}'.format(i)],
+                'Labels': {'app': 'bench{0}'.format(i)},
+                'Hostname': 'bench{0}'.format(i),
+                'Domainname': 'example.com'
+            },
+            'NetworkSettings': {
+                'IPAddress': '',
+                'Networks': {'bench': {'IPAddress': container_ip(i)}}
+            }
+        }
+    return containers
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0
+
+    def log_message(self, *args):
+        pass
+
+    def address_string(self):
+        return 'local'
+
+    def respond(self, body, status=200, content_type='application/json', headers=None):
+        if not isinstance(body, bytes):
+            if content_type == 'application/json':
+                body = json.dumps(body)
+            body = body.encode('utf-8')
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class DockerHandler(JSONHandler):
+    containers = {}
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        # Strip the API version prefix, e.g. /v1.24
+        if path.startswith('/v1.'):
+            path = '/' + path.split('/', 2)[2]
+        parts = path.strip('/').split('/')
+        if path == '/version':
+            return self.respond({'ApiVersion': '1.24', 'Version': 'bench'})
+        if path == '/containers/json':
+            return self.respond([{'Id': c} for c, v in self.containers.items() if v['State']['Running']])
+        if len(parts) == 3 and parts[0] == 'containers' and parts[2] == 'json':
+            container = self.containers.get(parts[1])
+            if container is None:
+                return self.respond({'message': 'No such container'}, 404)
+            return self.respond(container)
+        if path == '/networks':
+            return self.respond([{'Id': 'bench', 'Name': 'bench', 'Containers': {}}])
+        if len(parts) == 2 and parts[0] == 'networks':
+            return self.respond({
+                'Id': 'bench',
+                'Name': 'bench',
+                'Containers': dict(
+                    (c, {'IPv4Address': v['NetworkSettings']['Networks']['bench']['IPAddress'] + '/16'})
+                    for c, v in self.containers.items() if v['State']['Running']
+                )
+            })
+        if path == '/events':
+            # Never send any events; just hold the stream open.
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            while True:
+                time.sleep(3600)
+        return self.respond({'message': 'page not found'}, 404)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super(UnixHTTPServer, self).get_request()
+        return request, ('local', 0)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+STS_RESPONSE = """<AssumeRoleResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <AssumeRoleResult>
+    <Credentials>
+      <AccessKeyId>ASIABENCH{key}</AccessKeyId>
+      <SecretAccessKey>benchsecret{key}</SecretAccessKey>
+      <SessionToken>benchtoken{key}</SessionToken>
+      <Expiration>{expiration}</Expiration>
+    </Credentials>
+    <AssumedRoleUser>
+      <Arn>arn:aws:sts::{account}:assumed-role/{name}/{session}</Arn>
+      <AssumedRoleId>AROABENCH:{session}</AssumedRoleId>
+    </AssumedRoleUser>
+  </AssumeRoleResult>
+  <ResponseMetadata><RequestId>{request_id}</RequestId></ResponseMetadata>
+</AssumeRoleResponse>"""
+
+GET_ROLE_RESPONSE = """<GetRoleResponse xmlns="https://iam.amazonaws.com/doc/2010-05-08/">
+  <GetRoleResult>
+    <Role>
+      <Path>/</Path>
+      <RoleName>{name}</RoleName>
+      <RoleId>AROABENCH</RoleId>
+      <Arn>arn:aws:iam::{account}:role/{name}</Arn>
+      <CreateDate>2020-01-01T00:00:00Z</CreateDate>
+      <AssumeRolePolicyDocument>%7B%7D</AssumeRolePolicyDocument>
+    </Role>
+  </GetRoleResult>
+  <ResponseMetadata><RequestId>{request_id}</RequestId></ResponseMetadata>
+</GetRoleResponse>"""
+
+
+class AWSHandler(JSONHandler):
+    """Answers the STS AssumeRole and IAM GetRole query API actions."""
+    credential_duration = 3600
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        params = dict((k, v[0]) for k, v in parse_qs(self.rfile.read(length).decode('utf-8')).items())
+        action = params.get('Action')
+        if action == 'AssumeRole':
+            expiration = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.credential_duration)
+            arn = params['RoleArn']
+            body = STS_RESPONSE.format(
+                key=uuid.uuid4().hex[:12].upper(),
+                expiration=expiration.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                account=arn.split(':')[4],
+                name=arn.split('/')[-1],
+                session=params['RoleSessionName'],
+                request_id=uuid.uuid4()
+            )
+            return self.respond(body, content_type='text/xml')
+        if action == 'GetRole':
+            body = GET_ROLE_RESPONSE.format(name=params['RoleName'], account=ACCOUNT_ID, request_id=uuid.uuid4())
+            return self.respond(body, content_type='text/xml')
+        return self.respond('<ErrorResponse/>', status=400, content_type='text/xml')
+
+
+class MesosHandler(JSONHandler):
+    state = b'{}'
+
+    def do_GET(self):
+        return self.respond(self.state)
+
+
+def make_mesos_state(count):
+    tasks = []
+    for i in range(count):
+        tasks.append({
+            'labels': [{'key': 'IAM_ROLE', 'value': 'bench-mesos-role@{0}'.format(ACCOUNT_ID)}],
+            'statuses': [{
+                'state': 'TASK_RUNNING',
+                'container_status': {'network_infos': [{'ip_addresses': [{'ip_address': mesos_task_ip(i)}]}]}
+            }]
+        })
+    return {'frameworks': [{'executors': [{'tasks': tasks}]}]}
+
+
+IMDS_PATHS = {
+    'latest/meta-data/instance-id': 'i-0bench0000000000',
+    'latest/meta-data/local-ipv4': '10.0.0.10',
+    'latest/meta-data/placement/availability-zone': 'us-east-1a',
+    'latest/dynamic/instance-identity/document': json.dumps({
+        'accountId': ACCOUNT_ID,
+        'instanceId': 'i-0bench0000000000',
+        'region': 'us-east-1',
+        'availabilityZone': 'us-east-1a'
+    })
+}
+
+
+class IMDSHandler(JSONHandler):
+    def do_GET(self):
+        body = IMDS_PATHS.get(self.path.split('?', 1)[0].strip('/'))
+        if body is None:
+            return self.respond('', status=404, content_type='text/plain')
+        return self.respond(body, content_type='text/plain')
+
+    def do_PUT(self):
+        if self.path.strip('/') != 'latest/api/token':
+            return self.respond('', status=404, content_type='text/plain')
+        ttl = self.headers.get('X-aws-ec2-metadata-token-ttl-seconds', '21600')
+        return self.respond(
+            uuid.uuid4().hex,
+            content_type='text/plain',
+            headers={'X-aws-ec2-metadata-token-ttl-seconds': ttl}
+        )
+
+
+def _serve(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def start(args):
+    containers = make_containers(args.containers, args.roles, with_account=not args.role_lookup)
+    handler = type('Docker', (DockerHandler,), {'containers': containers, 'latency': args.docker_latency})
+    if os.path.exists(args.docker_socket):
+        os.unlink(args.docker_socket)
+    _serve(UnixHTTPServer(args.docker_socket, handler))
+    aws = type('AWS', (AWSHandler,), {'latency': args.sts_latency})
+    _serve(ThreadingHTTPServer(('127.0.0.1', args.aws_port), aws))
+    mesos = type('Mesos', (MesosHandler,), {'state': json.dumps(make_mesos_state(args.mesos_tasks)).encode()})
+    _serve(ThreadingHTTPServer(('127.0.0.1', args.mesos_port), mesos))
+    imds = type('IMDS', (IMDSHandler,), {'latency': args.imds_latency})
+    _serve(ThreadingHTTPServer(('127.0.0.1', args.imds_port), imds))
+
+
+def add_arguments(parser):
+    parser.add_argument('--containers', type=int, default=300, help='synthetic docker containers')
+    parser.add_argument('--roles', type=int, default=20, help='distinct IAM roles across containers')
+    parser.add_argument('--mesos-tasks', type=int, default=50, help='synthetic mesos tasks')
+    parser.add_argument('--role-lookup', action='store_true',
+                        help='use role names without an account, so roles are resolved with iam:GetRole')
+    parser.add_argument('--docker-socket', default='/tmp/metadataproxy-bench-docker.sock')
+    parser.add_argument('--aws-port', type=int, default=18001)
+    parser.add_argument('--mesos-port', type=int, default=18002)
+    parser.add_argument('--imds-port', type=int, default=18003)
+    parser.add_argument('--docker-latency', type=float, default=0.0005,
+                        help='seconds added to each docker API response')
+    parser.add_argument('--sts-latency', type=float, default=0.05,
+                        help='seconds added to each STS/IAM response')
+    parser.add_argument('--imds-latency', type=float, default=0.001,
+                        help='seconds added to each metadata service response')
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except socket.error:
+            time.sleep(0.1)
+    return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    start(args)
+    sys.stdout.write('fakes ready\n')
+    sys.stdout.flush()
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""End-to-end load benchmark for metadataproxy.
+
+Starts the local fakes from benchmarks/fakes.py, starts metadataproxy under
+gunicorn against them (flask with gevent workers, or the asyncio server with
+--server asyncio), and drives a mix of credential fetches, role-name
+listings, role info and passthrough requests from many simulated container
+IPs. Each simulated client binds to its
+container's loopback IP, so the proxy sees one source IP per container.
+
+Reports requests per second and p50/p99 latency per route. Results can be
+written as JSON with --output, and compared against an earlier run with
+--compare.
+
+Usage:
+    python benchmarks/run.py --duration 30 --concurrency 64 --output after.json --compare before.json
+
+Any metadataproxy setting can be passed through to the proxy with --env, e.g.
+--env CONTAINER_INDEX=true.
+"""
+# Import python libs
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakes  # NOQA
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVERS = {
+    'gevent': ['metadataproxy:app', '-k', 'gevent'],
+    'asyncio': ['metadataproxy.aio:make_app', '-k', 'aiohttp.GunicornWebWorker']
+}
+DEFAULT_MIX = 'credentials=60,list=15,info=5,passthrough=20'
+PASSTHROUGH_PATHS = [
+    '/latest/meta-data/instance-id',
+    '/latest/meta-data/local-ipv4',
+    '/latest/meta-data/placement/availability-zone',
+    '/latest/dynamic/instance-identity/document'
+]
+
+
+def parse_mix(mix):
+    routes = []
+    for item in mix.split(','):
+        route, weight = item.split('=')
+        routes.append((route.strip(), float(weight)))
+    return routes
+
+
+def request_path(route, role):
+    if route == 'credentials':
+        return '/latest/meta-data/iam/security-credentials/{0}'.format(role)
+    if route == 'list':
+        return '/latest/meta-data/iam/security-credentials/'
+    if route == 'info':
+        return '/latest/meta-data/iam/info'
+    if route == 'passthrough':
+        return random.choice(PASSTHROUGH_PATHS)
+    raise ValueError('Unknown route {0}'.format(route))
+
+
+def client_worker(args):
+    """Send requests for `duration` seconds from one process, using threads.
+
+    Returns latencies in seconds, and error counts, per route.
+    """
+    import threading
+    worker_id, options = args
+    random.seed(worker_id)
+    routes, weights = zip(*parse_mix(options['mix']))
+    latencies = dict((route, []) for route in routes)
+    errors = dict((route, 0) for route in routes)
+    lock = threading.Lock()
+    deadline = time.time() + options['duration']
+
+    def run():
+        connections = {}
+        while time.time() < deadline:
+            container = random.randrange(options['containers'])
+            source_ip = fakes.container_ip(container)
+            route = random.choices(routes, weights)[0]
+            path = request_path(route, fakes.role_name(container, options['roles']))
+            conn = connections.get(source_ip)
+            if conn is None:
+                conn = http.client.HTTPConnection(
+                    '127.0.0.1', options['port'], timeout=30, source_address=(source_ip, 0)
+                )
+                connections[source_ip] = conn
+            start = time.perf_counter()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                response.read()
+                ok = response.status == 200
+                if response.getheader('Connection', '').lower() == 'close':
+                    conn.close()
+                    del connections[source_ip]
+            except (http.client.HTTPException, OSError):
+                ok = False
+                conn.close()
+                del connections[source_ip]
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies[route].append(elapsed)
+                else:
+                    errors[route] += 1
+            # Keep a bounded number of idle keep-alive connections per thread.
+            if len(connections) > 8:
+                stale_ip = next(iter(connections))
+                connections.pop(stale_ip).close()
+        for conn in connections.values():
+            conn.close()
+
+    threads = [threading.Thread(target=run) for _ in range(options['threads'])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+def summarize(latencies, errors, duration):
+    results = {}
+    for route in sorted(latencies):
+        values = latencies[route]
+        results[route] = {
+            'requests': len(values),
+            'errors': errors[route],
+            'rps': len(values) / duration,
+            'p50_ms': percentile(values, 50) * 1000,
+            'p99_ms': percentile(values, 99) * 1000
+        }
+    all_values = [v for values in latencies.values() for v in values]
+    results['total'] = {
+        'requests': len(all_values),
+        'errors': sum(errors.values()),
+        'rps': len(all_values) / duration,
+        'p50_ms': percentile(all_values, 50) * 1000,
+        'p99_ms': percentile(all_values, 99) * 1000
+    }
+    return results
+
+
+def print_results(results, baseline=None):
+    header = '{0:<12} {1:>9} {2:>7} {3:>10} {4:>9} {5:>9}'.format(
+        'route', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms'
+    )
+    if baseline:
+        header += '  {0:>8} {1:>8}'.format('d req/s', 'd p99')
+    print(header)
+    for route, result in sorted(results.items(), key=lambda item: item[0] == 'total'):
+        line = '{0:<12} {1[requests]:>9} {1[errors]:>7} {1[rps]:>10.1f} {1[p50_ms]:>9.2f} {1[p99_ms]:>9.2f}'.format(
+            route, result
+        )
+        if baseline and route in baseline:
+            before = baseline[route]
+            line += '  {0:>+7.1f}% {1:>+7.1f}%'.format(
+                _change(before['rps'], result['rps']),
+                _change(before['p99_ms'], result['p99_ms'])
+            )
+        print(line)
+
+
+def _change(before, after):
+    if not before:
+        return 0.0
+    return (after - before) / before * 100
+
+
+def wait_for_proxy(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/latest/meta-data/instance-id')
+            conn.getresponse().read()
+            return True
+        except (http.client.HTTPException, OSError):
+            time.sleep(0.2)
+    return False
+
+
+def proxy_env(args):
+    env = dict(os.environ)
+    env.update({
+        'DOCKER_URL': 'unix://{0}'.format(args.docker_socket),
+        'METADATA_URL': 'http://127.0.0.1:{0}'.format(args.imds_port),
+        'MESOS_STATE_URL': 'http://127.0.0.1:{0}/state'.format(args.mesos_port),
+        'STS_ENDPOINT_URL': 'http://127.0.0.1:{0}'.format(args.aws_port),
+        'IAM_ENDPOINT_URL': 'http://127.0.0.1:{0}'.format(args.aws_port),
+        'AWS_ACCESS_KEY_ID': 'AKIABENCH',
+        'AWS_SECRET_ACCESS_KEY': 'bench',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'PYTHONPATH': ROOT
+    })
+    for item in args.env:
+        name, value = item.split('=', 1)
+        env[name] = value
+    return env
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    fakes.add_arguments(parser)
+    parser.add_argument('--port', type=int, default=18000, help='port to run metadataproxy on')
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn workers')
+    parser.add_argument('--server', choices=sorted(SERVERS), default='gevent',
+                        help='serve flask with gevent workers, or the asyncio server')
+    parser.add_argument('--duration', type=float, default=20, help='seconds to send load for')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds of load to send before measuring')
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent client connections')
+    parser.add_argument('--processes', type=int, default=4, help='client processes to spread connections over')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='route weights, e.g. {0}'.format(DEFAULT_MIX))
+    parser.add_argument('--env', action='append', default=[], help='NAME=VALUE setting passed to metadataproxy')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    processes = []
+    try:
+        fake = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'benchmarks', 'fakes.py')] + _fake_args(args),
+            stdout=subprocess.PIPE
+        )
+        processes.append(fake)
+        fake.stdout.readline()
+        proxy = subprocess.Popen(
+            ['gunicorn'] + SERVERS[args.server] +
+            ['--workers', str(args.workers), '-b', '127.0.0.1:{0}'.format(args.port), '--log-level', 'warning'],
+            env=proxy_env(args),
+            cwd=ROOT
+        )
+        processes.append(proxy)
+        if not wait_for_proxy(args.port):
+            sys.exit('metadataproxy did not start')
+
+        options = {
+            'port': args.port,
+            'mix': args.mix,
+            'containers': args.containers,
+            'roles': args.roles,
+            'threads': max(1, args.concurrency // args.processes)
+        }
+        pool = multiprocessing.Pool(args.processes)
+        if args.warmup:
+            warmup = dict(options, duration=args.warmup)
+            pool.map(client_worker, [(i, warmup) for i in range(args.processes)])
+        measured = dict(options, duration=args.duration)
+        runs = pool.map(client_worker, [(i, measured) for i in range(args.processes)])
+        pool.close()
+
+        latencies = {}
+        errors = {}
+        for run_latencies, run_errors in runs:
+            for route, values in run_latencies.items():
+                latencies.setdefault(route, []).extend(values)
+            for route, count in run_errors.items():
+                errors[route] = errors.get(route, 0) + count
+        results = summarize(latencies, errors, args.duration)
+        baseline = None
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)['results']
+        print_results(results, baseline)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'args': vars(args), 'results': results}, f, indent=2, sort_keys=True)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+
+
+def _fake_args(args):
+    fake_args = []
+    for name in ('containers', 'roles', 'mesos_tasks', 'docker_socket', 'aws_port', 'mesos_port',
+                 'imds_port', 'docker_latency', 'sts_latency', 'imds_latency'):
+        fake_args += ['--' + name.replace('_', '-'), str(getattr(args, name))]
+    if args.role_lookup:
+        fake_args.append('--role-lookup')
+    return fake_args
+
+
+if __name__ == '__main__':
+    main()
@@ -14,3 +14,5 @@ if app.config['MOCK_API']:
     from metadataproxy.routes import mock  # NOQA
 else:
     from metadataproxy.routes import proxy  # NOQA
+    from metadataproxy import roles
+    roles.start_background_workers()
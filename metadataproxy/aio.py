@@ -0,0 +1,395 @@
+"""An asyncio server for metadataproxy, as an alternative to Flask + gevent.
+
+It serves the same IAM and passthrough endpoints as routes/proxy.py, and
+shares roles.py's caches and background workers, but talks to the docker
+socket and the metadata service with native aiohttp clients. Requests that
+are answered from cached container mappings and assumed roles never leave
+the event loop. Slower paths that are built on blocking clients (container
+scans, reverse DNS, mesos, IAM and STS) run in the loop's thread pool.
+
+Run it with gunicorn's aiohttp worker:
+
+    gunicorn metadataproxy.aio:make_app -k aiohttp.GunicornWebWorker
+
+or, for development, with `python -m metadataproxy.aio`.
+"""
+# Import python libs
+import asyncio
+import logging
+
+# Import third party libs
+import aiohttp
+from aiohttp import web
+
+# Import metadataproxy libs
+from metadataproxy import app as flask_app
+from metadataproxy import imds
+from metadataproxy import metrics
+from metadataproxy import roles
+from metadataproxy.routes.proxy import _supports_iam
+
+log = logging.getLogger(__name__)
+
+# The docker API version docker-py 1.10 uses.
+DOCKER_API_VERSION = '1.24'
+CHUNK_SIZE = 8192
+
+
+class DockerClient(object):
+    """A minimal async client for the docker API."""
+
+    def __init__(self, url, timeout, breaker):
+        self._breaker = breaker
+        if url.startswith('unix://'):
+            connector = aiohttp.UnixConnector(path='/' + url[len('unix://'):].lstrip('/'))
+            base_url = 'http://docker'
+        else:
+            connector = aiohttp.TCPConnector()
+            base_url = url.replace('tcp://', 'http://', 1)
+        self._base_url = '{0}/v{1}'.format(base_url, DOCKER_API_VERSION)
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=timeout)
+        )
+
+    async def inspect_container(self, container_id):
+        """Inspect a container, returning None if it doesn't exist."""
+        url = '{0}/containers/{1}/json'.format(self._base_url, container_id)
+        self._breaker.before_call()
+        # Errors other than 4xx responses, and cancellation, count as
+        # failures.
+        failed = True
+        try:
+            async with self._session.get(url) as response:
+                if response.status == 404:
+                    container = None
+                else:
+                    response.raise_for_status()
+                    container = await response.json()
+            failed = False
+            return container
+        except aiohttp.ClientResponseError as e:
+            failed = e.status >= 500
+            raise
+        finally:
+            self._breaker.after_call(failed)
+
+    async def close(self):
+        await self._session.close()
+
+
+class MetadataClient(object):
+    """An async client for the upstream metadata service.
+
+    It shares imds.UPSTREAM_TOKEN with the WSGI app; the token is only
+    fetched, in the thread pool, when it needs renewing.
+    """
+
+    def __init__(self, url):
+        self._url = url
+        connector = aiohttp.TCPConnector(
+            limit=flask_app.config['METADATA_POOL_SIZE'],
+            force_close=not flask_app.config['METADATA_KEEPALIVE']
+        )
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=flask_app.config['METADATA_CONNECT_TIMEOUT'],
+            sock_read=flask_app.config['METADATA_READ_TIMEOUT']
+        )
+        self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def _token(self):
+        if not flask_app.config['METADATA_UPSTREAM_TOKEN']:
+            return None
+        if imds.UPSTREAM_TOKEN.needs_fetch():
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, imds.UPSTREAM_TOKEN.get)
+        return imds.UPSTREAM_TOKEN.get()
+
+    async def get(self, url):
+        """GET a path from the metadata service. The caller must release the
+        response."""
+        start = asyncio.get_event_loop().time()
+        try:
+            token = await self._token()
+            response = await self._get(url, token)
+            if token and response.status == 401:
+                response.release()
+                imds.UPSTREAM_TOKEN.invalidate(token)
+                response = await self._get(url, await self._token())
+            return response
+        finally:
+            duration = asyncio.get_event_loop().time() - start
+            metrics.observe('stage_duration_seconds', duration, stage='passthrough_upstream')
+
+    def _get(self, url, token):
+        headers = {imds.TOKEN_HEADER: token} if token else {}
+        return self._session.get('{0}/{1}'.format(self._url, url), headers=headers)
+
+    async def close(self):
+        await self._session.close()
+
+
+def _json_response(body):
+    return web.Response(body=body, content_type='application/json')
+
+
+def _empty_response(status):
+    return web.Response(status=status, content_type='text/html')
+
+
+async def _run_blocking(func, *args):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, func, *args)
+
+
+async def find_container(request, ip, budget=None):
+    """Find the container for ip, like roles.find_container.
+
+    Mapped IPs, and IPs known to a synced container index, only need an
+    async inspect. Anything else falls back to roles.find_container. With a
+    `budget`, the inspect of a mapped container raises asyncio.TimeoutError
+    after that many seconds; it carries on in the background, so that its
+    outcome still counts towards the docker circuit breaker.
+    """
+    container_id = roles.CONTAINER_MAPPING.get(ip)
+    mapped = container_id is not None
+    if not mapped and roles.CONTAINER_INDEX.synced:
+        container_id = roles.CONTAINER_INDEX.lookup(ip)
+    if container_id:
+        with roles.PrintingBlockTimer('Container inspect'):
+            inspect = request.app['docker'].inspect_container(container_id)
+            if mapped and budget:
+                container = await asyncio.wait_for(asyncio.shield(inspect), budget)
+            else:
+                container = await inspect
+        if container and container['State']['Running']:
+            if mapped:
+                metrics.incr('cache_lookups', cache='container_mapping', result='hit')
+            else:
+                roles._map_container(ip, container_id)
+            return container
+    return await _run_blocking(roles.find_container, ip)
+
+
+async def get_role_params(request, requested_role=None):
+    ip = request.remote
+    if flask_app.config['ROLE_MAPPING_FILE']:
+        params = roles.get_role_params_from_mapping(ip)
+    else:
+        params = roles.get_cached_role_params(ip)
+        if params is None:
+            try:
+                container = await find_container(request, ip, budget=roles.stale_lookup_budget(ip))
+            except (aiohttp.ClientError, asyncio.TimeoutError) + roles.DOCKER_ERRORS:
+                params = roles.get_stale_role_params(ip)
+                if params is None:
+                    raise
+            else:
+                params = roles.get_role_params_from_container(container)
+    if requested_role and requested_role != params['name']:
+        raise roles.UnexpectedRoleError
+    return params
+
+
+async def get_assumed_role(role_params):
+    assumed_role = roles.get_cached_assumed_role(role_params)
+    if assumed_role is None:
+        assumed_role = await _run_blocking(roles.get_assumed_role, role_params)
+    return assumed_role
+
+
+async def get_role_arn(role_params):
+    # ARNs that can't be generated are looked up in IAM, and cached, by
+    # roles.get_role_arn, so they're only looked up in the thread pool.
+    arn = roles._generated_role_arn(role_params)
+    if arn is None:
+        arn = await _run_blocking(roles.get_role_arn, role_params)
+    return arn
+
+
+def _endpoint(request):
+    """Name the endpoint the way flask does: by handler, or none for routing
+    errors."""
+    if request.match_info.http_exception is not None:
+        return 'none'
+    return request.match_info.handler.__name__
+
+
+@web.middleware
+async def check_imds_token(request, handler):
+    if _endpoint(request) != 'imds_token':
+        if not imds.token_allowed(request.headers.get(imds.TOKEN_HEADER), request.remote):
+            return _empty_response(401)
+    return await handler(request)
+
+
+@web.middleware
+async def circuit_open(request, handler):
+    try:
+        return await handler(request)
+    except roles.CircuitOpenError as e:
+        log.error('{0}; returning 503.'.format(e))
+        return _empty_response(503)
+
+
+@web.middleware
+async def count_request(request, handler):
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        metrics.incr('requests', endpoint=_endpoint(request), status=status)
+
+
+async def imds_token(request):
+    try:
+        ttl = int(request.headers.get(imds.TOKEN_TTL_HEADER, ''))
+    except ValueError:
+        return _empty_response(400)
+    if not 1 <= ttl <= imds.MAX_TOKEN_TTL:
+        return _empty_response(400)
+    token = imds.issue_token(request.remote, ttl)
+    return web.Response(
+        text=token,
+        content_type='text/plain',
+        headers={imds.TOKEN_TTL_HEADER: str(ttl)}
+    )
+
+
+async def iam_role_info(request):
+    if not _supports_iam(request.match_info['api_version']):
+        return await passthrough(request)
+
+    role_params = await get_role_params(request)
+    if not role_params['name']:
+        log.error('Role name not found; returning 404.')
+        return _empty_response(404)
+    log.debug('Providing IAM role info for {0}'.format(role_params['name']))
+    try:
+        assumed_role = await get_assumed_role(role_params)
+    except roles.GetRoleError:
+        return _json_response(roles.render_json({}))
+    except roles.StsThrottledError:
+        log.error('STS is throttled; returning 503.')
+        return _empty_response(503)
+    return _json_response(roles.role_info_json(await get_role_arn(role_params), assumed_role))
+
+
+async def iam_role_name(request):
+    if not _supports_iam(request.match_info['api_version']):
+        return await passthrough(request)
+
+    role_params = await get_role_params(request)
+    if role_params['name']:
+        return web.Response(text=role_params['name'], content_type='text/html')
+    else:
+        log.error('Role name not found; returning 404.')
+        return _empty_response(404)
+
+
+async def iam_role_name_redirect(request):
+    # Like flask's strict_slashes, rather than passing through to the real
+    # metadata service.
+    raise web.HTTPMovedPermanently(request.path + '/')
+
+
+async def iam_sts_credentials(request):
+    if not _supports_iam(request.match_info['api_version']):
+        return await passthrough(request)
+
+    requested_role = request.match_info['requested_role']
+    try:
+        role_params = await get_role_params(request, requested_role=requested_role.rstrip('/'))
+    except roles.UnexpectedRoleError:
+        msg = "Role name {0} doesn't match expected role for container"
+        log.error(msg.format(requested_role))
+        return _empty_response(404)
+
+    log.debug('Providing assumed role credentials for {0}'.format(role_params['name']))
+    try:
+        assumed_role = await get_assumed_role(role_params)
+    except roles.StsThrottledError:
+        log.error('STS is throttled; returning 503.')
+        return _empty_response(503)
+    return _json_response(roles.role_credentials_json(await get_role_arn(role_params), assumed_role))
+
+
+async def passthrough(request):
+    log.debug('Did not match credentials request url; passing through.')
+    url = request.path.lstrip('/')
+    metadata = request.app['metadata']
+    try:
+        ttl = imds.RESPONSE_CACHE.ttl_for(url)
+        if ttl:
+            cached = imds.RESPONSE_CACHE.get(url)
+            if cached is None:
+                upstream = await metadata.get(url)
+                async with upstream:
+                    cached = imds.CachedResponse(
+                        upstream.status,
+                        upstream.headers['content-type'],
+                        await upstream.read()
+                    )
+                if cached.status == 200:
+                    imds.RESPONSE_CACHE.set(url, ttl, cached)
+            response = web.Response(body=cached.body, status=cached.status)
+            response.headers['Content-Type'] = cached.content_type
+            return response
+        upstream = await metadata.get(url)
+    except asyncio.TimeoutError:
+        log.error('Timeout when proxying {0} to the metadata service'.format(url))
+        return _empty_response(504)
+    except aiohttp.ClientError:
+        log.exception('Error when proxying {0} to the metadata service'.format(url))
+        return _empty_response(502)
+    async with upstream:
+        response = web.StreamResponse(status=upstream.status)
+        response.headers['Content-Type'] = upstream.headers['content-type']
+        await response.prepare(request)
+        async for chunk in upstream.content.iter_chunked(CHUNK_SIZE):
+            await response.write(chunk)
+        await response.write_eof()
+    return response
+
+
+async def _start_clients(app):
+    app['docker'] = DockerClient(
+        flask_app.config['DOCKER_URL'],
+        flask_app.config['DOCKER_TIMEOUT'],
+        roles.DOCKER_BREAKER
+    )
+    app['metadata'] = MetadataClient(flask_app.config['METADATA_URL'])
+
+
+async def _close_clients(app):
+    await app['docker'].close()
+    await app['metadata'].close()
+
+
+async def make_app():
+    if flask_app.config['MOCK_API']:
+        raise RuntimeError('The asyncio server does not support MOCK_API')
+    app = web.Application(middlewares=[count_request, check_imds_token, circuit_open])
+    app.on_startup.append(_start_clients)
+    app.on_cleanup.append(_close_clients)
+    router = app.router
+    router.add_put('/{api_version}/api/token', imds_token)
+    router.add_get('/{api_version}/meta-data/iam/info', iam_role_info)
+    router.add_get('/{api_version}/meta-data/iam/info/{junk:.*}', iam_role_info)
+    router.add_get('/{api_version}/meta-data/iam/security-credentials', iam_role_name_redirect)
+    router.add_get('/{api_version}/meta-data/iam/security-credentials/', iam_role_name)
+    router.add_get(
+        '/{api_version}/meta-data/iam/security-credentials/{requested_role:.+}',
+        iam_sts_credentials
+    )
+    router.add_get('/{url:.*}', passthrough)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(make_app(), host=flask_app.config['HOST'], port=flask_app.config['PORT'])
@@ -0,0 +1,148 @@
+# Import python libs
+import logging
+import threading
+import time
+
+# Import metadataproxy libs
+from metadataproxy import metrics
+
+log = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+# Values of the `circuit_breaker_state` gauge.
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """Fail calls to a dependency fast while it's unhealthy.
+
+    After `failure_threshold` consecutive failures, the breaker opens, and
+    calls raise CircuitOpenError without reaching the dependency. After
+    `reset_timeout` seconds, one trial call is let through (half open): if it
+    succeeds the breaker closes, and if it fails, or is interrupted, the
+    breaker opens again. A trial that hasn't finished within `reset_timeout`
+    seconds is given up on, and another is let through.
+    `is_failure(e)` decides which exceptions count as the dependency being
+    unhealthy; others, like a 404, pass through without counting. A
+    `failure_threshold` of 0 disables the breaker.
+
+    The state is kept in the `circuit_breaker_state` gauge (0 closed, 1 half
+    open, 2 open), and rejected calls are counted in
+    `circuit_breaker_rejections`, both labelled with the dependency.
+    """
+
+    def __init__(self, dependency, failure_threshold=5, reset_timeout=30, is_failure=None):
+        self.dependency = dependency
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._is_failure = is_failure or (lambda e: True)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        # When the current half-open trial call started, if there is one.
+        self._trial_at = None
+        self._state = CLOSED
+        metrics.set_gauge('circuit_breaker_state', STATE_VALUES[CLOSED], dependency=dependency)
+
+    @property
+    def state(self):
+        return self._state
+
+    def _set_state(self, state):
+        log.warning('Circuit breaker for {0} is now {1}'.format(self.dependency, state))
+        self._state = state
+        metrics.set_gauge('circuit_breaker_state', STATE_VALUES[state], dependency=self.dependency)
+
+    def call(self, func, *args, **kwargs):
+        if not self._failure_threshold:
+            return func(*args, **kwargs)
+        self.before_call()
+        # Anything that isn't a classified exception, such as the call being
+        # interrupted, counts as a failure, so that a trial is always
+        # released.
+        failed = True
+        try:
+            result = func(*args, **kwargs)
+            failed = False
+            return result
+        except Exception as e:
+            failed = self._is_failure(e)
+            raise
+        finally:
+            self.after_call(failed)
+
+    def before_call(self):
+        """Raise CircuitOpenError if a call can't be made now.
+
+        For calls that can't be wrapped with call(), like coroutines, call
+        this before the call, and after_call() after it, in a finally block.
+        """
+        if not self._failure_threshold:
+            return
+        with self._lock:
+            if self._state == CLOSED:
+                return
+            if self._state == OPEN and time.time() - self._opened_at >= self._reset_timeout:
+                self._set_state(HALF_OPEN)
+            if self._state == HALF_OPEN:
+                now = time.time()
+                if self._trial_at is None or now - self._trial_at >= self._reset_timeout:
+                    self._trial_at = now
+                    return
+        metrics.incr('circuit_breaker_rejections', dependency=self.dependency)
+        raise CircuitOpenError('Circuit breaker for {0} is open'.format(self.dependency))
+
+    def after_call(self, failed):
+        if not self._failure_threshold:
+            return
+        with self._lock:
+            self._trial_at = None
+            if not failed:
+                self._failures = 0
+                if self._state != CLOSED:
+                    self._set_state(CLOSED)
+                return
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self._failure_threshold:
+                self._opened_at = time.time()
+                if self._state != OPEN:
+                    self._set_state(OPEN)
+
+
+class GuardedClient(object):
+    """Wrap a client so that its method calls go through a circuit breaker,
+    and are retried up to `retries` times on errors `is_retryable(e)` allows.
+
+    Other attributes are passed through as they are.
+    """
+
+    def __init__(self, client, breaker, retries=0, is_retryable=None):
+        self._client = client
+        self._breaker = breaker
+        self._retries = retries
+        self._is_retryable = is_retryable or (lambda e: False)
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def guarded(*args, **kwargs):
+            attempt = 0
+            while True:
+                try:
+                    return self._breaker.call(attr, *args, **kwargs)
+                except CircuitOpenError:
+                    raise
+                except Exception as e:
+                    if attempt >= self._retries or not self._is_retryable(e):
+                        raise
+                    attempt += 1
+                    log.warning('Retrying {0} {1} after error: {2}'.format(self._breaker.dependency, name, e))
+        return guarded
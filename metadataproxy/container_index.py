@@ -0,0 +1,195 @@
+# Import python libs
+import logging
+import threading
+import time
+
+# Import third party libs
+import docker.errors
+import requests
+
+log = logging.getLogger(__name__)
+
+# Container events that can change the set of IPs a container owns.
+CONTAINER_START_EVENTS = ('start', 'unpause')
+CONTAINER_STOP_EVENTS = ('die', 'destroy')
+NETWORK_EVENTS = ('connect', 'disconnect')
+
+
+def container_ips(container):
+    """Return the set of IP addresses a container can be matched by.
+
+    This covers the default bridge IP, the IP of every network the container
+    is attached to and the Rancher 1.2+ `io.rancher.container.ip` label.
+    """
+    ips = set()
+    network_settings = container.get('NetworkSettings') or {}
+    if network_settings.get('IPAddress'):
+        ips.add(network_settings['IPAddress'])
+    networks = network_settings.get('Networks') or {}
+    for network in networks.values():
+        if network and network.get('IPAddress'):
+            ips.add(network['IPAddress'])
+    labels = (container.get('Config') or {}).get('Labels') or {}
+    if labels.get('io.rancher.container.ip'):
+        ips.add(labels['io.rancher.container.ip'].split('/')[0])
+    return ips
+
+
+def network_container_ips(network):
+    """Return a dict of IP addresses to container IDs from an inspected docker
+    network."""
+    ips = {}
+    for container_id, endpoint in (network.get('Containers') or {}).items():
+        for key in ('IPv4Address', 'IPv6Address'):
+            if endpoint.get(key):
+                ips[endpoint[key].split('/')[0]] = container_id
+    return ips
+
+
+class ContainerIndex(object):
+    """An in-memory IP to container ID table kept current from docker events.
+
+    The table is built with a full scan when the indexer starts, and is then
+    updated from the docker `/events` stream. A full scan only happens again
+    as a resync after the event stream drops. Lookups are plain dict reads, so
+    they're safe to do from request greenlets without taking the lock.
+    `on_add` is called with every running container that's indexed, as
+    inspected, and `on_remove` with the ID of every container that stops or
+    is dropped from the table. `on_start` is only called for containers
+    indexed because of a start event, not ones found by a resync.
+    """
+
+    def __init__(self, client_factory, reconnect_delay=5, on_add=None, on_remove=None, on_start=None):
+        self._client_factory = client_factory
+        self._reconnect_delay = reconnect_delay
+        self._on_add = on_add
+        self._on_start = on_start
+        self._on_remove = on_remove
+        self._client = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._ip_to_id = {}
+        self._id_to_ips = {}
+        # True only while the table is built and the event stream is
+        # connected. Callers must treat the index as advisory otherwise.
+        self.synced = False
+
+    def lookup(self, ip):
+        return self._ip_to_id.get(ip)
+
+    def add(self, container):
+        """Index (or re-index) an inspected container."""
+        container_id = container['Id']
+        if not container.get('State', {}).get('Running'):
+            self.remove(container_id)
+            return
+        ips = container_ips(container)
+        with self._lock:
+            self._drop(container_id)
+            self._id_to_ips[container_id] = ips
+            for ip in ips:
+                self._ip_to_id[ip] = container_id
+        if self._on_add is not None:
+            self._on_add(container)
+
+    def remove(self, container_id):
+        with self._lock:
+            self._drop(container_id)
+        self._removed([container_id])
+
+    def _removed(self, container_ids):
+        if self._on_remove is None:
+            return
+        for container_id in container_ids:
+            self._on_remove(container_id)
+
+    def _drop(self, container_id):
+        for ip in self._id_to_ips.pop(container_id, ()):
+            if self._ip_to_id.get(ip) == container_id:
+                del self._ip_to_id[ip]
+
+    def resync(self):
+        """Rebuild the whole table from a full container scan."""
+        client = self._client
+        ip_to_id = {}
+        id_to_ips = {}
+        for summary in client.containers():
+            try:
+                container = client.inspect_container(summary['Id'])
+            except docker.errors.NotFound:
+                continue
+            if not container['State']['Running']:
+                continue
+            ips = container_ips(container)
+            id_to_ips[container['Id']] = ips
+            for ip in ips:
+                ip_to_id[ip] = container['Id']
+            if self._on_add is not None:
+                self._on_add(container)
+        with self._lock:
+            removed = set(self._id_to_ips) - set(id_to_ips)
+            self._ip_to_id = ip_to_id
+            self._id_to_ips = id_to_ips
+        self._removed(removed)
+        log.info('Container index resynced with {0} containers'.format(len(id_to_ips)))
+
+    def handle_event(self, event):
+        event_type = event.get('Type', 'container')
+        action = event.get('Action') or event.get('status')
+        actor = event.get('Actor') or {}
+        if event_type == 'container':
+            container_id = actor.get('ID') or event.get('id')
+            if action in CONTAINER_STOP_EVENTS:
+                self.remove(container_id)
+            elif action in CONTAINER_START_EVENTS:
+                container = self._reindex(container_id)
+                if container is not None and self._on_start is not None:
+                    self._on_start(container)
+        elif event_type == 'network' and action in NETWORK_EVENTS:
+            container_id = actor.get('Attributes', {}).get('container')
+            if container_id:
+                self._reindex(container_id)
+
+    def _reindex(self, container_id):
+        """Re-inspect and index a container, returning it if it's running."""
+        try:
+            container = self._client.inspect_container(container_id)
+        except docker.errors.NotFound:
+            self.remove(container_id)
+            return None
+        self.add(container)
+        if not container['State']['Running']:
+            return None
+        return container
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='container-index')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                if self._client is None:
+                    self._client = self._client_factory()
+                # Subscribe from just before the scan, so events that happen
+                # while we're scanning are replayed rather than lost.
+                since = int(time.time()) - 1
+                self.resync()
+                events = self._client.events(
+                    since=since,
+                    filters={'type': ['container', 'network']},
+                    decode=True
+                )
+                self.synced = True
+                for event in events:
+                    self.handle_event(event)
+                log.error('Docker event stream closed; resyncing container index')
+            except (docker.errors.APIError, requests.exceptions.RequestException):
+                log.exception('Docker event stream failed; resyncing container index')
+            except Exception:
+                log.exception('Unexpected error in container indexer')
+            self.synced = False
+            time.sleep(self._reconnect_delay)
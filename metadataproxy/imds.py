@@ -0,0 +1,254 @@
+# Import python libs
+import base64
+import collections
+import hashlib
+import hmac
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import timeit
+
+# Import third party libs
+import requests
+import requests.adapters
+
+# Import metadataproxy libs
+from metadataproxy import app
+from metadataproxy import metrics
+from metadataproxy.shared_cache import SharedCache
+
+log = logging.getLogger(__name__)
+
+_session = None
+
+TOKEN_HEADER = 'X-aws-ec2-metadata-token'
+TOKEN_TTL_HEADER = 'X-aws-ec2-metadata-token-ttl-seconds'
+# IMDSv2 token TTLs must be between 1 second and 6 hours.
+MAX_TOKEN_TTL = 21600
+# Renew the upstream token this many seconds before it expires.
+TOKEN_RENEWAL_MARGIN = 60
+# After the upstream metadata service refuses to issue a token, use IMDSv1
+# for this many seconds before asking again.
+TOKEN_UNSUPPORTED_BACKOFF = 300
+
+CachedResponse = collections.namedtuple('CachedResponse', ['status', 'content_type', 'body'])
+
+
+def session():
+    """Return the shared keep-alive session used for upstream requests.
+
+    Connections to the metadata service are pooled (METADATA_POOL_SIZE per
+    worker), rather than opened for every proxied request.
+    """
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=app.config['METADATA_POOL_SIZE']
+        )
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+        if not app.config['METADATA_KEEPALIVE']:
+            _session.headers['Connection'] = 'close'
+    return _session
+
+
+class UpstreamToken(object):
+    """A cached IMDSv2 session token for the upstream metadata service.
+
+    One token is shared by every proxied request, and renewed shortly before
+    its TTL runs out, so IMDSv2 costs one extra round-trip per token TTL
+    rather than one per request. If the upstream doesn't issue tokens, IMDSv1
+    is used.
+    """
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0
+        self._unsupported_until = 0
+
+    def get(self):
+        now = time.time()
+        if self._token and now < self._expires_at - TOKEN_RENEWAL_MARGIN:
+            return self._token
+        if now < self._unsupported_until:
+            return None
+        with self._lock:
+            if self._token and time.time() < self._expires_at - TOKEN_RENEWAL_MARGIN:
+                return self._token
+            self._fetch()
+            return self._token
+
+    def needs_fetch(self):
+        """Check whether get() would have to fetch a token from the upstream."""
+        now = time.time()
+        if self._token and now < self._expires_at - TOKEN_RENEWAL_MARGIN:
+            return False
+        return now >= self._unsupported_until
+
+    def invalidate(self, token):
+        with self._lock:
+            if self._token == token:
+                self._token = None
+
+    def _fetch(self):
+        try:
+            response = session().put(
+                '{0}/latest/api/token'.format(app.config['METADATA_URL']),
+                headers={TOKEN_TTL_HEADER: str(self._ttl)},
+                timeout=(app.config['METADATA_CONNECT_TIMEOUT'], app.config['METADATA_READ_TIMEOUT'])
+            )
+        except requests.exceptions.RequestException:
+            log.exception('Failed to fetch an IMDSv2 token; falling back to IMDSv1')
+            self._token = None
+            return
+        if response.status_code != 200:
+            msg = 'Metadata service returned {0} for an IMDSv2 token; falling back to IMDSv1'
+            log.warning(msg.format(response.status_code))
+            self._token = None
+            self._unsupported_until = time.time() + TOKEN_UNSUPPORTED_BACKOFF
+            return
+        self._token = response.text
+        self._expires_at = time.time() + self._ttl
+
+
+UPSTREAM_TOKEN = UpstreamToken(app.config['METADATA_TOKEN_TTL'])
+
+
+def get(url, stream=False):
+    """GET a path from the upstream metadata service.
+
+    When METADATA_UPSTREAM_TOKEN is enabled the request carries the shared
+    IMDSv2 token, and is retried once with a new token if the upstream
+    rejects it.
+    """
+    start = timeit.default_timer()
+    try:
+        token = UPSTREAM_TOKEN.get() if app.config['METADATA_UPSTREAM_TOKEN'] else None
+        response = _get(url, stream, token)
+        if token and response.status_code == 401:
+            response.close()
+            UPSTREAM_TOKEN.invalidate(token)
+            response = _get(url, stream, UPSTREAM_TOKEN.get())
+        return response
+    finally:
+        duration = timeit.default_timer() - start
+        metrics.observe('stage_duration_seconds', duration, stage='passthrough_upstream')
+
+
+def _get(url, stream, token):
+    headers = {TOKEN_HEADER: token} if token else {}
+    return session().get(
+        '{0}/{1}'.format(app.config['METADATA_URL'], url),
+        headers=headers,
+        stream=stream,
+        timeout=(app.config['METADATA_CONNECT_TIMEOUT'], app.config['METADATA_READ_TIMEOUT'])
+    )
+
+
+def _token_secret():
+    """Return IMDS_TOKEN_SECRET, or if it isn't set, a secret shared by every
+    worker on the host, so a token issued by one worker is valid in all."""
+    if app.config['IMDS_TOKEN_SECRET']:
+        return app.config['IMDS_TOKEN_SECRET']
+    directory = app.config['SHARED_CACHE_DIR'] or \
+        os.path.join(tempfile.gettempdir(), 'metadataproxy-{0}'.format(os.getuid()))
+    cache = SharedCache(directory, 'imds')
+    with cache.lock('token_secret'):
+        secret = cache.get('token_secret')
+        if secret is None:
+            secret = os.urandom(32)
+            cache.set('token_secret', secret, float('inf'))
+    return secret
+
+
+TOKEN_SECRET = _token_secret()
+
+
+def _sign(payload):
+    return hmac.new(TOKEN_SECRET, payload, hashlib.sha256).hexdigest()
+
+
+def issue_token(ip, ttl):
+    """Issue an IMDSv2 session token to a container.
+
+    Tokens are validated locally: they carry their expiry and the IP they
+    were issued to, signed with IMDS_TOKEN_SECRET.
+    """
+    payload = '{0}:{1}'.format(int(time.time()) + ttl, ip).encode('utf-8')
+    return '{0}.{1}'.format(base64.urlsafe_b64encode(payload).decode('ascii'), _sign(payload))
+
+
+def validate_token(token, ip):
+    """Check a container's IMDSv2 session token.
+
+    Returns True if it's valid, False if it has expired or was issued to
+    another IP, and None if it isn't a token this proxy signed.
+    """
+    try:
+        encoded, signature = token.split('.', 1)
+        payload = base64.urlsafe_b64decode(encoded.encode('ascii'))
+        expires_at, token_ip = payload.decode('utf-8').split(':', 1)
+        expires_at = int(expires_at)
+    except (ValueError, TypeError, UnicodeError):
+        return None
+    if not hmac.compare_digest(_sign(payload), signature):
+        return None
+    return token_ip == ip and time.time() < expires_at
+
+
+def token_allowed(token, ip):
+    """Decide whether a request with this token header, or None, is let
+    through.
+
+    Unless IMDS_REQUIRE_TOKEN is set, requests without a token, and with
+    tokens this proxy didn't sign, are served like IMDSv1 requests.
+    """
+    if token is None:
+        return not app.config['IMDS_REQUIRE_TOKEN']
+    valid = validate_token(token, ip)
+    if valid is None:
+        return not app.config['IMDS_REQUIRE_TOKEN']
+    return valid
+
+
+class ResponseCache(object):
+    """A TTL cache of upstream metadata responses, for configured paths.
+
+    `patterns` maps path regexes to a TTL in seconds; the first pattern that
+    matches a path decides whether, and for how long, its response is cached.
+    Lookups are counted in the `cache_lookups` metric, with
+    `cache="passthrough"`.
+    """
+
+    def __init__(self, patterns):
+        self._rules = [(re.compile(pattern), ttl) for pattern, ttl in patterns.items()]
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def ttl_for(self, path):
+        for regex, ttl in self._rules:
+            if regex.search(path):
+                return ttl
+        return None
+
+    def get(self, path):
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] > time.time():
+            metrics.incr('cache_lookups', cache='passthrough', result='hit')
+            return entry[1]
+        metrics.incr('cache_lookups', cache='passthrough', result='miss')
+        return None
+
+    def set(self, path, ttl, response):
+        with self._lock:
+            self._entries[path] = (time.time() + ttl, response)
+
+
+RESPONSE_CACHE = ResponseCache(app.config['PASSTHROUGH_CACHE_PATTERNS'])
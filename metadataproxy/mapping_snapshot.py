@@ -0,0 +1,174 @@
+# Import python libs
+import contextlib
+import errno
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 2
+# How long, in seconds, to remember that an IP was unmapped, so that other
+# workers' older mappings of it aren't merged back in.
+REMOVED_TTL = 86400
+# How long, in seconds, to wait for another worker to finish writing the
+# snapshot before writing without the lock.
+LOCK_TIMEOUT = 10
+
+
+class MappingSnapshot(object):
+    """Periodically persist an IP to container ID mapping to a local file.
+
+    The snapshot is loaded back at startup so that a restarted proxy doesn't
+    have to scan for every container again. Loaded entries are revalidated
+    lazily, by the normal check that a cached container is still running.
+    Only container IDs are persisted; no credentials or role parameters are
+    written to disk.
+
+    Every worker process writes the same file, so each write merges in the
+    snapshot already on disk, under a file lock: the snapshot is the union
+    of the workers' mappings, and where they disagree about an IP, the most
+    recent mapping, or unmapping, of it wins.
+    """
+
+    def __init__(self, path, mapping, interval=30):
+        self._path = path
+        self._mapping = mapping
+        self._interval = interval
+        self._thread = None
+        self._written = None
+        # This worker's mappings, as {ip: (container_id, mapped_at)}, and the
+        # IPs it has unmapped since it last wrote, as {ip: removed_at}.
+        self._mapped = {}
+        self._removed = {}
+
+    def load(self):
+        try:
+            containers, _ = self._read()
+        except (IOError, OSError):
+            log.info('No container mapping snapshot at {0}'.format(self._path))
+            return
+        except ValueError:
+            log.exception('Ignoring corrupt container mapping snapshot {0}'.format(self._path))
+            return
+        if containers is None:
+            log.warning('Ignoring container mapping snapshot with unknown version')
+            return
+        for ip, (container_id, mapped_at) in containers.items():
+            if self._mapping.setdefault(ip, container_id) == container_id:
+                self._mapped[ip] = (container_id, mapped_at)
+        self._written = dict((ip, entry[0]) for ip, entry in containers.items())
+        log.info('Loaded {0} container mappings from {1}'.format(len(containers), self._path))
+
+    def _read(self):
+        """Return the snapshot's mappings, as {ip: (container_id, mapped_at)},
+        and unmapped IPs, as {ip: removed_at}, or (None, None) if its version
+        is unknown."""
+        with open(self._path, 'r') as f:
+            snapshot = json.load(f)
+        version = snapshot.get('version')
+        if version == 1:
+            # Version 1 snapshots didn't record when IPs were mapped.
+            return dict((ip, (container_id, 0)) for ip, container_id in snapshot.get('containers', {}).items()), {}
+        if version != SNAPSHOT_VERSION:
+            return None, None
+        containers = dict((ip, tuple(entry)) for ip, entry in snapshot.get('containers', {}).items())
+        return containers, snapshot.get('removed', {})
+
+    def _update(self, containers):
+        """Record when each of this worker's mappings changed."""
+        now = time.time()
+        for ip, container_id in containers.items():
+            if self._mapped.get(ip, (None,))[0] != container_id:
+                self._mapped[ip] = (container_id, now)
+        for ip in set(self._mapped) - set(containers):
+            del self._mapped[ip]
+            self._removed[ip] = now
+
+    def _merge(self, containers, removed):
+        """Merge this worker's mappings into those read from the snapshot,
+        in place, letting the most recent change to each IP win."""
+        for ip, (container_id, mapped_at) in self._mapped.items():
+            if mapped_at >= containers.get(ip, (None, 0))[1] and mapped_at >= removed.get(ip, 0):
+                containers[ip] = (container_id, mapped_at)
+                removed.pop(ip, None)
+        for ip, removed_at in self._removed.items():
+            if removed_at >= containers.get(ip, (None, 0))[1]:
+                containers.pop(ip, None)
+                removed[ip] = max(removed_at, removed.get(ip, 0))
+        cutoff = time.time() - REMOVED_TTL
+        for ip in [ip for ip, removed_at in removed.items() if removed_at < cutoff]:
+            del removed[ip]
+
+    def save(self):
+        containers = dict(self._mapping)
+        if containers == self._written:
+            return
+        self._update(containers)
+        with self._lock():
+            try:
+                on_disk, removed = self._read()
+            except (IOError, OSError, ValueError):
+                on_disk = removed = None
+            if on_disk is None:
+                on_disk, removed = {}, {}
+            self._merge(on_disk, removed)
+            self._write({'version': SNAPSHOT_VERSION, 'containers': on_disk, 'removed': removed})
+        self._removed = {}
+        self._written = containers
+
+    def _write(self, snapshot):
+        directory = os.path.dirname(os.path.abspath(self._path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.container-mapping')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f)
+            os.rename(tmp_path, self._path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    @contextlib.contextmanager
+    def _lock(self):
+        # Polled, like SharedCache.lock, so that waiting doesn't block every
+        # greenlet in the worker.
+        fd = os.open(self._path + '.lock', os.O_CREAT | os.O_RDWR, 0o600)
+        deadline = time.time() + LOCK_TIMEOUT
+        locked = False
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                    break
+                except (IOError, OSError) as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                if time.time() > deadline:
+                    log.warning('Timed out waiting for the container mapping snapshot lock')
+                    break
+                time.sleep(0.01)
+            yield
+        finally:
+            if locked:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='mapping-snapshot')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            try:
+                self.save()
+            except Exception:
+                log.exception('Failed to write container mapping snapshot {0}'.format(self._path))
@@ -0,0 +1,178 @@
+# Import python libs
+import hashlib
+import json
+import logging
+import threading
+import time
+
+# Import third party libs
+import requests
+
+# Import metadataproxy libs
+from metadataproxy.circuit_breaker import CircuitOpenError
+
+log = logging.getLogger(__name__)
+
+
+def index_state(state):
+    """Build a task IP to container mapping from a mesos agent state object.
+
+    Only running tasks with labels are indexed. A task's labels are used as a
+    replacement for docker env and labels.
+    """
+    index = {}
+    for framework in state['frameworks']:
+        for executor in framework['executors']:
+            for task in executor['tasks']:
+                if 'labels' not in task:
+                    continue
+                container = None
+                for status in task['statuses']:
+                    if status['state'] != 'TASK_RUNNING':
+                        continue
+                    for network in status['container_status']['network_infos']:
+                        for ip_map in network['ip_addresses']:
+                            if container is None:
+                                env = []
+                                for label in task['labels']:
+                                    env.append('{0}={1}'.format(label['key'], label['value']))
+                                container = {'Config': {'Env': env, 'Labels': env}}
+                            index.setdefault(ip_map['ip_address'], container)
+    return index
+
+
+class MesosState(object):
+    """A shared, indexed snapshot of the mesos agent state.
+
+    The agent state is fetched at most once per refresh interval, normally by
+    a background thread, and indexed by task IP so that lookups are a dict
+    read. Unchanged state (by ETag, or by digest of the body when the agent
+    doesn't send one) isn't re-parsed. With a shared cache, a snapshot
+    fetched by one worker is reused by the others. With a circuit breaker,
+    fetches are skipped while the agent is failing.
+
+    A lookup for an IP that isn't in the snapshot, such as a newly launched
+    task's, refreshes it once it's more than `miss_refresh_interval` seconds
+    old; concurrent misses share that fetch.
+    """
+
+    def __init__(self, url, timeout, refresh_interval=60, shared_cache=None, breaker=None,
+                 miss_refresh_interval=5):
+        self._url = url
+        self._timeout = timeout
+        self._refresh_interval = refresh_interval
+        self._miss_refresh_interval = miss_refresh_interval
+        self._session = requests.Session()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._index = {}
+        self._etag = None
+        self._digest = None
+        self._fetched_at = None
+        self._shared_cache = shared_cache
+        self._breaker = breaker
+
+    def lookup(self, ip):
+        if self._fetched_at is None:
+            # Nothing to answer from yet; wait for the first fetch.
+            with self._lock:
+                if self._fetched_at is None:
+                    self.refresh()
+        elif self._thread is None and time.time() - self._fetched_at > self._refresh_interval:
+            # No background refresher; refresh in-line, but let concurrent
+            # lookups use the current snapshot rather than wait for it.
+            if self._lock.acquire(False):
+                try:
+                    self.refresh()
+                finally:
+                    self._lock.release()
+        container = self._index.get(ip)
+        if container is None and time.time() - self._fetched_at > self._miss_refresh_interval:
+            # Lookups that wait for the lock skip their own refresh once the
+            # fetch they waited on has finished.
+            with self._lock:
+                if time.time() - self._fetched_at > self._miss_refresh_interval:
+                    self.refresh(max_age=self._miss_refresh_interval)
+            container = self._index.get(ip)
+        return container
+
+    def refresh(self, max_age=None):
+        """Fetch the agent state, or use another worker's snapshot, if it's
+        less than `max_age` (by default, the refresh interval) seconds old."""
+        headers = {}
+        if self._etag:
+            headers['If-None-Match'] = self._etag
+        try:
+            if self._refresh_from_shared_cache(self._refresh_interval if max_age is None else max_age):
+                return
+            if self._breaker is not None:
+                response = self._breaker.call(self._fetch, headers)
+            else:
+                response = self._fetch(headers)
+            if response.status_code == 304:
+                self._publish()
+                return
+            body = response.content
+            digest = hashlib.sha1(body).hexdigest()
+            if digest != self._digest:
+                self._index = index_state(json.loads(body.decode('utf-8')))
+                self._digest = digest
+                self._etag = response.headers.get('ETag')
+                log.debug('Indexed {0} mesos task IPs'.format(len(self._index)))
+            self._publish()
+        except requests.exceptions.Timeout:
+            log.error('Timeout when trying to call the mesos http api: {0}'.format(self._url))
+        except CircuitOpenError:
+            log.error('Not calling the failing mesos http api: {0}'.format(self._url))
+        except requests.exceptions.RequestException:
+            log.exception('Error while trying to call the mesos http api: {0}'.format(self._url))
+        except (KeyError, TypeError, ValueError):
+            log.exception('Error while trying to lookup the required keys in the json object')
+        finally:
+            # Failed fetches also count, so a down agent is retried once per
+            # interval rather than on every lookup.
+            self._fetched_at = time.time()
+
+    def _fetch(self, headers):
+        response = self._session.get(self._url, timeout=self._timeout, headers=headers)
+        if response.status_code != 304:
+            response.raise_for_status()
+        return response
+
+    def _refresh_from_shared_cache(self, max_age):
+        if self._shared_cache is None:
+            return False
+        shared = self._shared_cache.get('state')
+        if shared is None:
+            return False
+        fetched_at, digest, index = shared
+        if time.time() - fetched_at >= max_age:
+            return False
+        if digest != self._digest:
+            self._index = index
+            self._digest = digest
+            self._etag = None
+        return True
+
+    def _publish(self):
+        if self._shared_cache is None:
+            return
+        now = time.time()
+        self._shared_cache.set(
+            'state',
+            (now, self._digest, self._index),
+            now + self._refresh_interval
+        )
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='mesos-state')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self.refresh()
+            time.sleep(self._refresh_interval)
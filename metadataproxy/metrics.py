@@ -0,0 +1,137 @@
+# Import python libs
+import bisect
+import logging
+import socket
+import threading
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+log = logging.getLogger(__name__)
+
+PREFIX = 'metadataproxy_'
+# Latency histogram buckets, in seconds.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+_server_thread = None
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def incr(name, value=1, **labels):
+    """Increment the counter `name` with the given labels."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    """Record `value` in the histogram `name` with the given labels."""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(BUCKETS), 0, 0.0]
+        bucket = bisect.bisect_left(BUCKETS, value)
+        if bucket < len(BUCKETS):
+            histogram[0][bucket] += 1
+        histogram[1] += 1
+        histogram[2] += value
+
+
+def get(name, **labels):
+    return _counters.get(_key(name, labels), 0)
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    pairs = []
+    for label, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('{0}="{1}"'.format(label, value))
+    return '{' + ','.join(pairs) + '}'
+
+
+def render():
+    """Render every metric in the Prometheus text exposition format."""
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        histograms = sorted((key, (list(h[0]), h[1], h[2])) for key, h in _histograms.items())
+    lines = []
+    typed = set()
+    for (name, labels), value in counters:
+        name = PREFIX + name + '_total'
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE {0} counter'.format(name))
+        lines.append('{0}{1} {2}'.format(name, _format_labels(labels), value))
+    for (name, labels), value in gauges:
+        name = PREFIX + name
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE {0} gauge'.format(name))
+        lines.append('{0}{1} {2}'.format(name, _format_labels(labels), value))
+    for (name, labels), (buckets, count, total) in histograms:
+        name = PREFIX + name
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE {0} histogram'.format(name))
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS, buckets):
+            cumulative += bucket_count
+            le = _format_labels(labels, [('le', repr(bound))])
+            lines.append('{0}_bucket{1} {2}'.format(name, le, cumulative))
+        lines.append('{0}_bucket{1} {2}'.format(name, _format_labels(labels, [('le', '+Inf')]), count))
+        lines.append('{0}_count{1} {2}'.format(name, _format_labels(labels), count))
+        lines.append('{0}_sum{1} {2!r}'.format(name, _format_labels(labels), total))
+    return '\n'.join(lines) + '\n'
+
+
+def _metrics_app(environ, start_response):
+    if environ.get('PATH_INFO') != '/metrics':
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b'']
+    body = render().encode('utf-8')
+    start_response('200 OK', [
+        ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+        ('Content-Length', str(len(body)))
+    ])
+    return [body]
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve(host, port, port_range=1):
+    """Serve /metrics on the first free port in [port, port + port_range).
+
+    Metrics are per process, so each gunicorn worker serves its own, on its
+    own port.
+    """
+    global _server_thread
+    if _server_thread is not None:
+        return
+    for candidate in range(port, port + port_range):
+        try:
+            server = make_server(host, candidate, _metrics_app, handler_class=_QuietHandler)
+        except socket.error:
+            continue
+        _server_thread = threading.Thread(target=server.serve_forever, name='metrics-server')
+        _server_thread.daemon = True
+        _server_thread.start()
+        log.info('Serving metrics on {0}:{1}'.format(host, candidate))
+        return
+    log.error('No free port to serve metrics on in {0}-{1}'.format(port, port + port_range - 1))
@@ -0,0 +1,49 @@
+# Import python libs
+import logging
+import threading
+from concurrent import futures
+
+# Import metadataproxy libs
+from metadataproxy import metrics
+
+log = logging.getLogger(__name__)
+
+
+class Prewarmer(object):
+    """Run `warm(container)` in the background for newly started containers.
+
+    At most `concurrency` containers are warmed at once; others queue. A
+    container that's already queued isn't queued again, and containers are
+    dropped rather than queued once `max_pending` are waiting, so a burst of
+    starts can't build an unbounded backlog. Outcomes are counted in the
+    `prewarm_containers` metric; `warm` returns the result label.
+    """
+
+    def __init__(self, warm, concurrency=4, max_pending=1000):
+        self._warm = warm
+        self._max_pending = max_pending
+        self._executor = futures.ThreadPoolExecutor(max_workers=concurrency)
+        self._lock = threading.Lock()
+        self._pending = set()
+
+    def submit(self, container):
+        container_id = container['Id']
+        with self._lock:
+            if container_id in self._pending:
+                return
+            if len(self._pending) >= self._max_pending:
+                metrics.incr('prewarm_containers', result='dropped')
+                return
+            self._pending.add(container_id)
+        self._executor.submit(self._run, container)
+
+    def _run(self, container):
+        try:
+            result = self._warm(container)
+        except Exception:
+            log.exception('Failed to pre-warm credentials for container {0}'.format(container['Id']))
+            result = 'failed'
+        finally:
+            with self._lock:
+                self._pending.discard(container['Id'])
+        metrics.incr('prewarm_containers', result=result)
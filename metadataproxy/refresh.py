@@ -0,0 +1,98 @@
+# Import python libs
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class RefreshScheduler(object):
+    """Re-run a refresh callback for tracked keys ahead of their expiry.
+
+    Each tracked key is scheduled to be refreshed at a random point within
+    `lead_time` seconds before its refresh deadline, so that keys that were
+    first fetched together don't all get refreshed together. Keys that haven't
+    been used for `idle_timeout` seconds are dropped rather than refreshed.
+    """
+
+    def __init__(self, refresh, lead_time=120, idle_timeout=7200, retry_delay=30):
+        self._refresh = refresh
+        self._lead_time = lead_time
+        self._idle_timeout = idle_timeout
+        self._retry_delay = retry_delay
+        self._cond = threading.Condition()
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._thread = None
+
+    def track(self, key, args, deadline):
+        """Schedule `refresh(*args)` to run before `deadline` (epoch seconds)."""
+        due = deadline - random.uniform(0, self._lead_time)
+        with self._cond:
+            entry = self._entries.get(key)
+            last_used = entry['last_used'] if entry else time.time()
+            self._entries[key] = {
+                'args': args,
+                'due': due,
+                'deadline': deadline,
+                'last_used': last_used
+            }
+            heapq.heappush(self._heap, (due, next(self._counter), key))
+            self._cond.notify()
+
+    def touch(self, key):
+        entry = self._entries.get(key)
+        if entry:
+            entry['last_used'] = time.time()
+
+    def forget(self, key):
+        with self._cond:
+            self._entries.pop(key, None)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='refresh-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _next_due(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                due, _, key = self._heap[0]
+                if due > now:
+                    self._cond.wait(due - now)
+                    continue
+                heapq.heappop(self._heap)
+                entry = self._entries.get(key)
+                # Skip heap items superseded by a later track() or forget().
+                if entry is None or entry['due'] != due:
+                    continue
+                if now - entry['last_used'] > self._idle_timeout:
+                    log.debug('Not refreshing idle key {0}'.format(key))
+                    del self._entries[key]
+                    continue
+                return key, entry
+
+    def _run(self):
+        while True:
+            key, entry = self._next_due()
+            try:
+                self._refresh(*entry['args'])
+            except Exception:
+                log.exception('Background refresh of {0} failed'.format(key))
+                retry_at = time.time() + self._retry_delay
+                if retry_at < entry['deadline']:
+                    with self._cond:
+                        if self._entries.get(key) is entry:
+                            entry['due'] = retry_at
+                            heapq.heappush(self._heap, (retry_at, next(self._counter), key))
+                            self._cond.notify()
@@ -0,0 +1,57 @@
+# Import python libs
+import logging
+import threading
+import time
+from concurrent import futures
+
+# Import metadataproxy libs
+from metadataproxy import metrics
+
+log = logging.getLogger(__name__)
+
+
+class Revalidator(object):
+    """Refresh stale entries in the background, retrying until they expire.
+
+    `submit(key, refresh, deadline)` runs `refresh()` on a small thread pool,
+    unless a refresh of `key` is already pending. A refresh that fails is
+    retried every `retry_delay` seconds, for as long as that's before
+    `deadline` (epoch seconds). Outcomes are counted in the
+    `stale_revalidations` metric, labelled with the source: `refreshed`,
+    `retrying` for each failed attempt that will be retried, and `failed`.
+    """
+
+    def __init__(self, source, concurrency=4, retry_delay=5):
+        self.source = source
+        self._retry_delay = retry_delay
+        self._executor = futures.ThreadPoolExecutor(max_workers=concurrency)
+        self._lock = threading.Lock()
+        self._pending = set()
+
+    def submit(self, key, refresh, deadline):
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        self._executor.submit(self._run, key, refresh, deadline)
+
+    def _run(self, key, refresh, deadline):
+        try:
+            refresh()
+            result = 'refreshed'
+        except Exception:
+            log.exception('Background {0} refresh of {1} failed'.format(self.source, key))
+            if time.time() + self._retry_delay < deadline:
+                metrics.incr('stale_revalidations', source=self.source, result='retrying')
+                timer = threading.Timer(
+                    self._retry_delay,
+                    self._executor.submit,
+                    (self._run, key, refresh, deadline)
+                )
+                timer.daemon = True
+                timer.start()
+                return
+            result = 'failed'
+        with self._lock:
+            self._pending.discard(key)
+        metrics.incr('stale_revalidations', source=self.source, result=result)
@@ -0,0 +1,63 @@
+# Import python libs
+import logging
+import socket
+import threading
+import time
+from concurrent import futures
+
+# Import metadataproxy libs
+from metadataproxy import metrics
+
+log = logging.getLogger(__name__)
+
+
+class ReverseDNSCache(object):
+    """A TTL cache of reverse DNS (PTR) lookups.
+
+    Names are cached for `ttl` seconds, and failed lookups for `negative_ttl`
+    seconds, so an IP without a PTR record doesn't cost a DNS round-trip on
+    every request. Lookups run on a small thread pool; concurrent lookups of
+    the same IP share one resolution, and callers wait at most `timeout`
+    seconds for it. A resolution that outlives the timeout still populates
+    the cache when it completes. Lookups are counted in the `cache_lookups`
+    metric, with `cache="reverse_dns"`.
+    """
+
+    def __init__(self, ttl=300, negative_ttl=30, timeout=1, max_workers=4):
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._timeout = timeout
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._pending = {}
+
+    def lookup(self, ip):
+        """Return the name for ip, or None if it has none."""
+        entry = self._entries.get(ip)
+        if entry is not None and entry[0] > time.time():
+            metrics.incr('cache_lookups', cache='reverse_dns', result='hit')
+            return entry[1]
+        metrics.incr('cache_lookups', cache='reverse_dns', result='miss')
+        with self._lock:
+            future = self._pending.get(ip)
+            if future is None:
+                future = self._pending[ip] = self._executor.submit(self._resolve, ip)
+        try:
+            return future.result(self._timeout)
+        except futures.TimeoutError:
+            log.error('gethostbyaddr timed out for {0}'.format(ip))
+            return None
+
+    def _resolve(self, ip):
+        try:
+            name = socket.gethostbyaddr(ip)[0]
+            ttl = self._ttl
+        except socket.error as e:
+            log.error('gethostbyaddr failed: {0}'.format(e.args))
+            name = None
+            ttl = self._negative_ttl
+        with self._lock:
+            self._entries[ip] = (time.time() + ttl, name)
+            self._pending.pop(ip, None)
+        return name
@@ -0,0 +1,95 @@
+# Import python libs
+import collections
+import datetime
+import threading
+import time
+
+# Import third party libs
+import dateutil.tz
+
+# Import metadataproxy libs
+from metadataproxy import metrics
+
+# How often, in seconds, to sweep expired roles out of the cache.
+SWEEP_INTERVAL = 60
+
+
+class RoleCache(object):
+    """A bounded cache of assumed roles, by role ARN.
+
+    It supports the dict operations the proxy uses on ROLES. At most
+    `max_entries` roles are kept, evicting the least recently used, and roles
+    whose credentials have expired are dropped, on access and by a periodic
+    sweep, so a long-running proxy's memory stays flat as containers and
+    their roles come and go. `on_evict(arn, assumed_role)` is called for
+    every evicted role. The cache size is kept in the `role_cache_entries`
+    gauge, and evictions are counted in the `cache_evictions` metric, with
+    `cache="roles"` and the reason.
+    """
+
+    def __init__(self, max_entries=1000, on_evict=None):
+        self._max_entries = max_entries
+        self._on_evict = on_evict
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._swept_at = time.time()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, arn):
+        return self.get(arn) is not None
+
+    def __getitem__(self, arn):
+        assumed_role = self.get(arn)
+        if assumed_role is None:
+            raise KeyError(arn)
+        return assumed_role
+
+    def get(self, arn, default=None):
+        evicted = []
+        with self._lock:
+            assumed_role = self._entries.get(arn)
+            if assumed_role is None:
+                return default
+            if _expired(assumed_role, _now()):
+                del self._entries[arn]
+                evicted.append((arn, assumed_role, 'expired'))
+                assumed_role = default
+            else:
+                self._entries.move_to_end(arn)
+        if evicted:
+            self._evicted(evicted)
+        return assumed_role
+
+    def __setitem__(self, arn, assumed_role):
+        evicted = []
+        with self._lock:
+            self._entries[arn] = assumed_role
+            self._entries.move_to_end(arn)
+            if time.time() - self._swept_at > SWEEP_INTERVAL:
+                self._swept_at = time.time()
+                now = _now()
+                for key, value in list(self._entries.items()):
+                    if _expired(value, now):
+                        del self._entries[key]
+                        evicted.append((key, value, 'expired'))
+            while len(self._entries) > self._max_entries:
+                key, value = self._entries.popitem(last=False)
+                evicted.append((key, value, 'lru'))
+        self._evicted(evicted)
+
+    def _evicted(self, evicted):
+        metrics.set_gauge('role_cache_entries', len(self._entries))
+        for arn, assumed_role, reason in evicted:
+            metrics.incr('cache_evictions', cache='roles', reason=reason)
+            if self._on_evict is not None:
+                self._on_evict(arn, assumed_role)
+
+
+def _now():
+    return datetime.datetime.now(dateutil.tz.tzutc())
+
+
+def _expired(assumed_role, now):
+    return assumed_role['Credentials']['Expiration'] <= now
@@ -0,0 +1,112 @@
+# Import python libs
+import ipaddress
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+def build_tables(mappings):
+    """Build lookup tables from a dict of IP addresses or CIDR ranges to roles.
+
+    Returns a dict of exact IP address strings to roles, for the common case
+    of single-address keys, and, per IP version, a list of
+    (prefix length, {network address as int: role}) tables ordered from the
+    longest prefix to the shortest. Keys that aren't addresses or ranges are
+    skipped.
+    """
+    exact = {}
+    prefixes = {4: {}, 6: {}}
+    for key, role in mappings.items():
+        try:
+            network = ipaddress.ip_network(key, strict=False)
+        except ValueError:
+            log.warning('Ignoring role mapping for invalid IP address or range {0}'.format(key))
+            continue
+        if network.num_addresses == 1:
+            exact[str(network.network_address)] = role
+        # Single addresses are in the prefix tables too, so that an address
+        # written differently than in the file still matches.
+        table = prefixes[network.version].setdefault(network.prefixlen, {})
+        table[int(network.network_address)] = role
+    ranges = {}
+    for version, tables in prefixes.items():
+        ranges[version] = sorted(tables.items(), reverse=True)
+    return exact, ranges
+
+
+class RoleMapping(object):
+    """IP to role mappings from ROLE_MAPPING_FILE, reloaded when it changes.
+
+    Keys are IP addresses or CIDR ranges; an IP gets the role of the longest
+    range containing it. Exact addresses are a single dict lookup, and ranges
+    cost one dict lookup per distinct prefix length in the file. The file is
+    polled every `reload_interval` seconds, and on a change its new tables are
+    swapped in atomically. A file that fails to load at startup is an error;
+    one that fails to reload is logged, and the previous mappings are kept.
+    """
+
+    def __init__(self, path, reload_interval=5):
+        self._path = path
+        self._reload_interval = reload_interval
+        self._tables = ({}, {4: [], 6: []})
+        self._stat = None
+        self._thread = None
+
+    def load(self):
+        stat = self._file_stat()
+        with open(self._path, 'r') as f:
+            tables = build_tables(json.load(f))
+        self._tables = tables
+        self._stat = stat
+        log.info('Loaded role mappings from {0}'.format(self._path))
+
+    def _file_stat(self):
+        st = os.stat(self._path)
+        return st.st_ino, st.st_size, st.st_mtime
+
+    def get(self, ip, default=None):
+        exact, ranges = self._tables
+        role = exact.get(ip)
+        if role is not None:
+            return role
+        try:
+            version, bits = 4, 32
+            packed = socket.inet_pton(socket.AF_INET, ip)
+        except (socket.error, TypeError):
+            try:
+                version, bits = 6, 128
+                packed = socket.inet_pton(socket.AF_INET6, ip)
+            except (socket.error, TypeError):
+                return default
+        address_int = int.from_bytes(packed, 'big')
+        for prefixlen, table in ranges[version]:
+            network_int = address_int >> (bits - prefixlen) << (bits - prefixlen)
+            role = table.get(network_int)
+            if role is not None:
+                return role
+        return default
+
+    def start(self):
+        if self._thread is not None or not self._reload_interval:
+            return
+        self._thread = threading.Thread(target=self._run, name='role-mapping')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self._reload_interval)
+            try:
+                stat = self._file_stat()
+                if stat != self._stat:
+                    # Only retry a file that fails to load once it changes
+                    # again.
+                    self._stat = stat
+                    self.load()
+            except Exception:
+                log.exception('Failed to reload role mappings from {0}'.format(self._path))
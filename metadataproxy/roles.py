@@ -1,10 +1,13 @@
 # Import python libs
+import collections
 import datetime
 import json
 import logging
 import re
-import socket
+import threading
+import time
 import timeit
+from concurrent import futures
 
 # Import third party libs
 import boto3
@@ -12,27 +15,162 @@ import dateutil.tz
 import docker
 import docker.errors
 import requests
+from botocore.config import Config
+import botocore.exceptions
 from botocore.exceptions import ClientError
-from cachetools import cached, TTLCache
+from cachetools import TTLCache
 
 # Import metadataproxy libs
 from metadataproxy import app
+from metadataproxy import metrics
+from metadataproxy.circuit_breaker import CLOSED, CircuitBreaker, CircuitOpenError, GuardedClient
+from metadataproxy.container_index import ContainerIndex, container_ips, network_container_ips
+from metadataproxy.mapping_snapshot import MappingSnapshot
+from metadataproxy.mesos import MesosState
+from metadataproxy.prewarm import Prewarmer
+from metadataproxy.refresh import RefreshScheduler
+from metadataproxy.revalidate import Revalidator
+from metadataproxy.role_cache import RoleCache
+from metadataproxy.reverse_dns import ReverseDNSCache
+from metadataproxy.role_mapping import RoleMapping
+from metadataproxy.shared_cache import SharedCache
+from metadataproxy.singleflight import SingleFlight
+from metadataproxy.sts_limiter import StsLimiter, StsThrottledError
+from metadataproxy.sts_pool import StsClientPool, StsEndpoint
 
 log = logging.getLogger(__name__)
 
-ROLES = {}
+ROLES = RoleCache(
+    max_entries=app.config['ROLE_CACHE_MAX_ENTRIES'],
+    on_evict=lambda arn, assumed_role: _forget_role(arn, assumed_role)
+)
+# Serialized role info and credentials responses, keyed by role ARN, as in
+# ROLES, and response type, with the assumed role they were rendered from.
+# A refreshed role's responses replace the previous ones, whatever session
+# name it was assumed with.
+ROLE_RESPONSES = {}
 CONTAINER_MAPPING = {}
+# Role params parsed from each container's env and labels, by container ID.
+CONTAINER_ROLE_PARAMS = {}
+# Role ARNs looked up with iam.get_role by role name, when they can't be
+# generated, and errors for role names IAM doesn't know.
+IAM_ROLE_ARNS = TTLCache(maxsize=1024, ttl=app.config['IAM_ROLE_ARN_CACHE_TTL'])
+IAM_ROLE_ERRORS = TTLCache(maxsize=1024, ttl=app.config['IAM_ROLE_ARN_NEGATIVE_TTL'])
+_iam_role_arns_lock = threading.Lock()
+# Container IDs by the HOSTNAME_MATCH_REGEX group of the container's FQDN, for
+# ROLE_REVERSE_LOOKUP, and the reverse.
+HOSTNAME_INDEX = {}
+CONTAINER_HOSTNAME_KEYS = {}
 _docker_client = None
+_stale_docker_client = None
 _iam_client = None
 _sts_client = None
 
+ROLE_MAPPINGS = RoleMapping(
+    app.config['ROLE_MAPPING_FILE'],
+    reload_interval=app.config['ROLE_MAPPING_RELOAD_INTERVAL']
+)
 if app.config['ROLE_MAPPING_FILE']:
-    with open(app.config.get('ROLE_MAPPING_FILE'), 'r') as f:
-        ROLE_MAPPINGS = json.loads(f.read())
-else:
-    ROLE_MAPPINGS = {}
+    ROLE_MAPPINGS.load()
 
 RE_IAM_ARN = re.compile(r"arn:aws:iam::(\d+):role/(.*)")
+RE_STAGE_CHARS = re.compile(r"[^a-z0-9]+")
+RE_HOSTNAME_MATCH = re.compile(app.config['HOSTNAME_MATCH_REGEX'])
+# Errors from a docker daemon that's down or unhealthy.
+DOCKER_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    docker.errors.APIError,
+    CircuitOpenError
+)
+# How long, in seconds, to keep retrying a failed background revalidation of a
+# stale container mapping.
+STALE_CONTAINER_RETRY_WINDOW = 300
+
+CONTAINER_INDEX = ContainerIndex(
+    lambda: docker.Client(base_url=app.config['DOCKER_URL']),
+    reconnect_delay=app.config['CONTAINER_INDEX_RECONNECT_DELAY'],
+    on_add=lambda container: _index_container_hostname(container),
+    on_remove=lambda container_id: _forget_container(container_id),
+    on_start=lambda container: _container_started(container)
+)
+PREWARMER = Prewarmer(
+    lambda container: _prewarm_container(container),
+    concurrency=app.config['ROLE_PREWARM_CONCURRENCY']
+)
+# Role ARNs pre-warmed for a started container that haven't been requested
+# since.
+PREWARMED_ROLES = {}
+REVERSE_DNS = ReverseDNSCache(
+    ttl=app.config['REVERSE_DNS_CACHE_TTL'],
+    negative_ttl=app.config['REVERSE_DNS_NEGATIVE_TTL'],
+    timeout=app.config['REVERSE_DNS_TIMEOUT']
+)
+ROLE_REFRESHER = RefreshScheduler(
+    lambda kwargs: assume_role(kwargs, refresh=True),
+    lead_time=app.config['ROLE_REFRESH_LEAD_TIME'],
+    idle_timeout=app.config['ROLE_REFRESH_IDLE_TIMEOUT']
+)
+DOCKER_BREAKER = CircuitBreaker(
+    'docker',
+    failure_threshold=app.config['CIRCUIT_BREAKER_FAILURES'],
+    reset_timeout=app.config['CIRCUIT_BREAKER_RESET_TIMEOUT'],
+    is_failure=lambda e: _is_docker_failure(e)
+)
+STS_BREAKER = CircuitBreaker(
+    'sts',
+    failure_threshold=app.config['CIRCUIT_BREAKER_FAILURES'],
+    reset_timeout=app.config['CIRCUIT_BREAKER_RESET_TIMEOUT'],
+    is_failure=lambda e: _is_aws_failure(e)
+)
+IAM_BREAKER = CircuitBreaker(
+    'iam',
+    failure_threshold=app.config['CIRCUIT_BREAKER_FAILURES'],
+    reset_timeout=app.config['CIRCUIT_BREAKER_RESET_TIMEOUT'],
+    is_failure=lambda e: _is_aws_failure(e)
+)
+MESOS_BREAKER = CircuitBreaker(
+    'mesos',
+    failure_threshold=app.config['CIRCUIT_BREAKER_FAILURES'],
+    reset_timeout=app.config['CIRCUIT_BREAKER_RESET_TIMEOUT']
+)
+# Background refreshes for stale roles and containers served with
+# SERVE_STALE.
+STALE_ROLES = Revalidator('sts', retry_delay=app.config['SERVE_STALE_RETRY_DELAY'])
+STALE_CONTAINERS = Revalidator('docker', retry_delay=app.config['SERVE_STALE_RETRY_DELAY'])
+ASSUME_ROLE_FLIGHTS = SingleFlight('sts_assume_role')
+IAM_GET_ROLE_FLIGHTS = SingleFlight('iam_get_role')
+CONTAINER_SCAN_FLIGHTS = SingleFlight('container_scan')
+CONTAINER_SCAN_EXECUTOR = futures.ThreadPoolExecutor(
+    max_workers=app.config['CONTAINER_SCAN_CONCURRENCY']
+)
+if app.config['SHARED_CACHE_DIR']:
+    SHARED_ROLES = SharedCache(app.config['SHARED_CACHE_DIR'], 'roles')
+    SHARED_CONTAINERS = SharedCache(app.config['SHARED_CACHE_DIR'], 'containers')
+    SHARED_MESOS_STATE = SharedCache(app.config['SHARED_CACHE_DIR'], 'mesos')
+    SHARED_STS_LIMITER = SharedCache(app.config['SHARED_CACHE_DIR'], 'sts_limiter')
+else:
+    SHARED_ROLES = SHARED_CONTAINERS = SHARED_MESOS_STATE = SHARED_STS_LIMITER = None
+STS_LIMITER = StsLimiter(
+    app.config['STS_RATE_LIMIT'],
+    app.config['STS_RATE_BURST'],
+    retries=app.config['STS_THROTTLE_RETRIES'],
+    max_wait=app.config['STS_ADMISSION_TIMEOUT'],
+    shared_cache=SHARED_STS_LIMITER
+)
+MESOS_STATE = MesosState(
+    app.config['MESOS_STATE_URL'],
+    app.config['MESOS_STATE_TIMEOUT'],
+    refresh_interval=app.config['MESOS_STATE_REFRESH_INTERVAL'],
+    shared_cache=SHARED_MESOS_STATE,
+    breaker=MESOS_BREAKER,
+    miss_refresh_interval=app.config['MESOS_STATE_MISS_REFRESH_INTERVAL']
+)
+CONTAINER_MAPPING_SNAPSHOT = MappingSnapshot(
+    app.config['CONTAINER_MAPPING_SNAPSHOT_FILE'],
+    CONTAINER_MAPPING,
+    interval=app.config['CONTAINER_MAPPING_SNAPSHOT_INTERVAL']
+)
 
 
 class BlockTimer(object):
@@ -46,11 +184,16 @@ class BlockTimer(object):
 
 
 class PrintingBlockTimer(BlockTimer):
+    """Log the time a block took, and record it in the
+    `stage_duration_seconds` histogram, labelled by the prefix."""
+
     def __init__(self, prefix=''):
         self.prefix = prefix
+        self.stage = RE_STAGE_CHARS.sub('_', prefix.lower()).strip('_') or 'unknown'
 
     def __exit__(self, *args):
         super(PrintingBlockTimer, self).__exit__(*args)
+        metrics.observe('stage_duration_seconds', self.exec_duration, stage=self.stage)
         msg = "Execution took {0:f}s".format(self.exec_duration)
         if self.prefix:
             msg = self.prefix + ': ' + msg
@@ -68,160 +211,449 @@ def log_exec_time(method):
 def docker_client():
     global _docker_client
     if _docker_client is None:
-        _docker_client = docker.Client(base_url=app.config['DOCKER_URL'])
+        _docker_client = GuardedClient(
+            docker.Client(base_url=app.config['DOCKER_URL'], timeout=app.config['DOCKER_TIMEOUT']),
+            DOCKER_BREAKER,
+            retries=app.config['DOCKER_RETRIES'],
+            is_retryable=lambda e: isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+        )
     return _docker_client
 
 
+def stale_docker_client():
+    """A docker client that gives up after SERVE_STALE_DOCKER_TIMEOUT seconds,
+    without retrying, for revalidating mappings whose role params can be
+    served stale.
+
+    It bypasses DOCKER_BREAKER, so that docker being slower than the budget
+    doesn't open the breaker for lookups that have nothing stale to serve.
+    """
+    global _stale_docker_client
+    if _stale_docker_client is None:
+        _stale_docker_client = docker.Client(
+            base_url=app.config['DOCKER_URL'],
+            timeout=app.config['SERVE_STALE_DOCKER_TIMEOUT']
+        )
+    return _stale_docker_client
+
+
+def _is_docker_failure(e):
+    if isinstance(e, docker.errors.APIError):
+        return e.is_server_error()
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def _aws_config(max_retries):
+    return Config(
+        connect_timeout=app.config['AWS_CONNECT_TIMEOUT'],
+        read_timeout=app.config['AWS_READ_TIMEOUT'],
+        retries={'max_attempts': max_retries}
+    )
+
+
+def _is_aws_failure(e):
+    if isinstance(e, ClientError):
+        return e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+    return isinstance(e, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError))
+
+
 def iam_client():
     global _iam_client
     if _iam_client is None:
-        _iam_client = boto3.client('iam')
+        config = _aws_config(app.config['AWS_MAX_RETRIES'])
+        if app.config['IAM_ENDPOINT_URL']:
+            client = boto3.client('iam', endpoint_url=app.config['IAM_ENDPOINT_URL'], config=config)
+        else:
+            client = boto3.client('iam', config=config)
+        _iam_client = GuardedClient(client, IAM_BREAKER)
     return _iam_client
 
 
 def sts_client():
     global _sts_client
+    if _sts_client is None and app.config['STS_REGIONS'] and not app.config['STS_ENDPOINT_URL']:
+        _sts_client = _sts_client_pool(app.config['STS_REGIONS'])
     if _sts_client is None:
         aws_region = app.config.get('AWS_REGION')
+        # With the STS rate limiter on, throttled calls are retried by
+        # STS_LIMITER, which backs off and lowers its rate, rather than by
+        # botocore, and other transient errors are retried by the guarded
+        # client.
+        limited = bool(app.config['STS_RATE_LIMIT'])
+        config = _aws_config(0 if limited else app.config['AWS_MAX_RETRIES'])
 
-        _sts_client = boto3.client(
-            service_name='sts',
-            region_name=aws_region,
-            endpoint_url=f'https://sts.{aws_region}.amazonaws.com'
-        ) if aws_region else boto3.client(service_name='sts')
+        if app.config['STS_ENDPOINT_URL']:
+            client = boto3.client(
+                service_name='sts',
+                region_name=aws_region or None,
+                endpoint_url=app.config['STS_ENDPOINT_URL'],
+                config=config
+            )
+        else:
+            client = boto3.client(
+                service_name='sts',
+                region_name=aws_region,
+                endpoint_url=f'https://sts.{aws_region}.amazonaws.com',
+                config=config
+            ) if aws_region else boto3.client(service_name='sts', config=config)
+        _sts_client = GuardedClient(
+            client,
+            STS_BREAKER,
+            retries=app.config['AWS_MAX_RETRIES'] if limited else 0,
+            is_retryable=_is_aws_failure
+        )
     return _sts_client
 
 
+def _sts_client_pool(regions):
+    # Failing over to another endpoint is a better retry than retrying the
+    # same one, so botocore doesn't retry pooled calls.
+    config = _aws_config(0)
+    endpoints = []
+    for region in regions:
+        client = boto3.client(
+            service_name='sts',
+            region_name=region,
+            endpoint_url=f'https://sts.{region}.amazonaws.com',
+            config=config
+        )
+        breaker = CircuitBreaker(
+            'sts_{0}'.format(region),
+            failure_threshold=app.config['CIRCUIT_BREAKER_FAILURES'],
+            reset_timeout=app.config['CIRCUIT_BREAKER_RESET_TIMEOUT'],
+            is_failure=_is_aws_failure
+        )
+        endpoints.append(StsEndpoint(region, client, breaker))
+    return StsClientPool(endpoints, _is_aws_failure)
+
+
 @log_exec_time
-def find_container(ip):
-    pattern = re.compile(app.config['HOSTNAME_MATCH_REGEX'])
+def find_container(ip, mapped_client=None):
     client = docker_client()
-    # Try looking at the container mapping cache first
+    # Try looking at the container mapping cache first, then at mappings other
+    # workers have resolved.
     container_id = CONTAINER_MAPPING.get(ip)
+    if not container_id and SHARED_CONTAINERS:
+        container_id = SHARED_CONTAINERS.get(ip)
     if container_id:
         log.info('Container id for IP {0} in cache'.format(ip))
         try:
             with PrintingBlockTimer('Container inspect'):
-                container = client.inspect_container(container_id)
+                container = (mapped_client or client).inspect_container(container_id)
             # Only return a cached container if it is running.
             if container['State']['Running']:
+                metrics.incr('cache_lookups', cache='container_mapping', result='hit')
+                CONTAINER_MAPPING[ip] = container_id
                 return container
             else:
                 log.error('Container id {0} is no longer running'.format(ip))
-                if ip in CONTAINER_MAPPING:
-                    del CONTAINER_MAPPING[ip]
+                _unmap_container(ip)
         except docker.errors.NotFound:
             msg = 'Container id {0} no longer mapped to {1}'
             log.error(msg.format(container_id, ip))
-            if ip in CONTAINER_MAPPING:
-                del CONTAINER_MAPPING[ip]
+            _unmap_container(ip)
+    else:
+        metrics.incr('cache_lookups', cache='container_mapping', result='miss')
 
-    _fqdn = None
-    with PrintingBlockTimer('Reverse DNS'):
-        if app.config['ROLE_REVERSE_LOOKUP']:
+    # Then try the event-driven container index. While it is synced it knows
+    # about every running container's IPs, so a miss means no scan can match
+    # by IP either.
+    if CONTAINER_INDEX.synced:
+        container_id = CONTAINER_INDEX.lookup(ip)
+        if container_id:
             try:
-                _fqdn = socket.gethostbyaddr(ip)[0]
-            except socket.error as e:
-                log.error('gethostbyaddr failed: {0}'.format(e.args))
-                pass
+                with PrintingBlockTimer('Container inspect'):
+                    container = client.inspect_container(container_id)
+                if container['State']['Running']:
+                    msg = 'Container id {0} mapped to {1} by container index'
+                    log.debug(msg.format(container_id, ip))
+                    _map_container(ip, container_id)
+                    return container
+            except docker.errors.NotFound:
+                CONTAINER_INDEX.remove(container_id)
+        elif not app.config['ROLE_REVERSE_LOOKUP']:
+            return _container_not_found(ip)
 
+    hostname_key = None
+    if app.config['ROLE_REVERSE_LOOKUP']:
+        with PrintingBlockTimer('Reverse DNS'):
+            hostname_key = _hostname_key(REVERSE_DNS.lookup(ip))
+        container = _find_container_by_hostname(client, ip, hostname_key)
+        if container is not None:
+            return container
+        # While it's synced, the container index has also indexed every
+        # running container's hostname, so a scan can't match either.
+        if CONTAINER_INDEX.synced and not CONTAINER_INDEX.lookup(ip):
+            return _container_not_found(ip)
+
+    # Try the IP tables of docker's networks, which cover every container's
+    # IPs in a call per network. Only hostname matches need a full scan.
+    if app.config['CONTAINER_NETWORK_LOOKUP']:
+        container = _find_container_by_network(client, ip)
+        if container is not None:
+            return container
+        if not app.config['ROLE_REVERSE_LOOKUP']:
+            return _container_not_found(ip)
+
+    # Fall back to scanning every running container.
+    container = _shared_scan(
+        'scan',
+        _scan_containers,
+        client,
+        lambda scan: _match_scanned_container(scan, ip, hostname_key)
+    )
+    if container is not None:
+        return container
+
+    return _container_not_found(ip)
+
+
+def _shared_scan(name, scan, client, match):
+    """Return match(scan(client)), sharing the scan with concurrent lookups.
+
+    Concurrent misses share one scan, which maps the IPs of every container
+    it finds, so a burst of unknown IPs costs a single pass. A shared scan
+    that started before this lookup may have missed a container started
+    since, so a miss on one of those is retried with a new scan.
+    """
+    requested_at = time.time()
+    result = CONTAINER_SCAN_FLIGHTS.do(name, scan, client)
+    found = match(result)
+    if found is None and result.started_at < requested_at:
+        result = CONTAINER_SCAN_FLIGHTS.do(name, scan, client)
+        found = match(result)
+    return found
+
+
+# The result of a container scan: when it started, and the inspected
+# containers by IP and by hostname key.
+ContainerScan = collections.namedtuple('ContainerScan', 'started_at by_ip by_hostname')
+# The result of a network scan: when it started, and container IDs by IP.
+NetworkScan = collections.namedtuple('NetworkScan', 'started_at by_ip')
+
+
+def _find_container_by_network(client, ip):
+    container_id = _shared_scan('networks', _scan_networks, client, lambda scan: scan.by_ip.get(ip))
+    if not container_id:
+        return None
+    try:
+        with PrintingBlockTimer('Container inspect'):
+            container = client.inspect_container(container_id)
+    except docker.errors.NotFound:
+        return None
+    if not container['State']['Running']:
+        return None
+    msg = 'Container id {0} mapped to {1} by network IP match'
+    log.debug(msg.format(container_id, ip))
+    _map_container(ip, container_id)
+    return container
+
+
+def _scan_networks(client):
+    """Read the container IPs of every docker network, and map them all."""
+    started_at = time.time()
+    with PrintingBlockTimer('Network fetch'):
+        network_ids = [n['Id'] for n in client.networks()]
+    by_ip = {}
+    with PrintingBlockTimer('Network scan'):
+        for network in CONTAINER_SCAN_EXECUTOR.map(client.inspect_network, network_ids):
+            by_ip.update(network_container_ips(network))
+    for _ip, container_id in by_ip.items():
+        _map_container(_ip, container_id)
+    return NetworkScan(started_at, by_ip)
+
+
+def _scan_containers(client):
+    """Inspect every running container, CONTAINER_SCAN_CONCURRENCY at a
+    time, and map all of their IPs."""
+    started_at = time.time()
     with PrintingBlockTimer('Container fetch'):
         _ids = [c['Id'] for c in client.containers()]
 
-    for _id in _ids:
-        try:
-            with PrintingBlockTimer('Container inspect'):
-                c = client.inspect_container(_id)
-        except docker.errors.NotFound:
-            log.error('Container id {0} not found'.format(_id))
-            continue
-        # Try matching container to caller by IP address
-        _ip = c['NetworkSettings']['IPAddress']
-        if ip == _ip:
-            msg = 'Container id {0} mapped to {1} by IP match'
-            log.debug(msg.format(_id, ip))
-            CONTAINER_MAPPING[ip] = _id
-            return c
-        # Try matching container to caller by sub network IP address
-        _networks = c['NetworkSettings']['Networks']
-        if _networks:
-            for _network in _networks:
-                if _networks[_network]['IPAddress'] == ip:
-                    msg = 'Container id {0} mapped to {1} by sub-network IP match'
-                    log.debug(msg.format(_id, ip))
-                    CONTAINER_MAPPING[ip] = _id
-                    return c
-        # Not Found ? Let's see if we are running under rancher 1.2+,which uses a label to store the IP
-        try:
-            _labels = c.get('Config', {}).get('Labels', {})
-        except (KeyError, ValueError):
-            _labels = {}
-        try:
-            if _labels.get('io.rancher.container.ip'):
-                _ip = _labels.get('io.rancher.container.ip').split("/")[0]
-        except docker.errors.NotFound:
-            log.error('Container: {0} Label container.ip not found'.format(_id))
-        if ip == _ip:
-            msg = 'Container id {0} mapped to {1} by Rancher IP match'
-            log.debug(msg.format(_id, ip))
-            CONTAINER_MAPPING[ip] = _id
-            return c
-        # Try matching container to caller by hostname match
-        if app.config['ROLE_REVERSE_LOOKUP']:
-            hostname = c['Config']['Hostname']
-            domain = c['Config']['Domainname']
-            fqdn = '{0}.{1}'.format(hostname, domain)
-            # Default pattern matches _fqdn == fqdn
-            _groups = re.match(pattern, _fqdn).groups()
-            groups = re.match(pattern, fqdn).groups()
-            if _groups and groups:
-                if groups[0] == _groups[0]:
-                    msg = 'Container id {0} mapped to {1} by FQDN match'
-                    log.debug(msg.format(_id, ip))
-                    CONTAINER_MAPPING[ip] = _id
-                    return c
-        # Try to find the container over the mesos state api and use the labels attached to it
-        # as a replacement for docker env and labels
-        if app.config['MESOS_STATE_LOOKUP']:
-            mesos_container = find_mesos_container(ip)
-            if mesos_container is not None:
-                return mesos_container
+    by_ip = {}
+    by_hostname = {}
+    with PrintingBlockTimer('Container scan'):
+        inspected = CONTAINER_SCAN_EXECUTOR.map(lambda _id: _inspect_scanned_container(client, _id), _ids)
+        # Containers are matched in the order docker lists them, so where
+        # containers share an IP or hostname, the first one listed wins.
+        for c in inspected:
+            if c is None:
+                continue
+            for _ip in container_ips(c):
+                by_ip.setdefault(_ip, c)
+            # Index hostnames along the way, for ROLE_REVERSE_LOOKUP.
+            key = _index_container_hostname(c)
+            if key is not None:
+                by_hostname.setdefault(key, c)
+    for _ip, c in by_ip.items():
+        _map_container(_ip, c['Id'])
+    return ContainerScan(started_at, by_ip, by_hostname)
+
+
+def _inspect_scanned_container(client, _id):
+    try:
+        return client.inspect_container(_id)
+    except docker.errors.NotFound:
+        log.error('Container id {0} not found'.format(_id))
+        return None
+
+
+def _match_scanned_container(scan, ip, hostname_key):
+    c = scan.by_ip.get(ip)
+    if c is not None:
+        msg = 'Container id {0} mapped to {1} by IP match'
+        log.debug(msg.format(c['Id'], ip))
+        return c
+    c = scan.by_hostname.get(hostname_key) if hostname_key is not None else None
+    if c is not None:
+        msg = 'Container id {0} mapped to {1} by FQDN match'
+        log.debug(msg.format(c['Id'], ip))
+        _map_container(ip, c['Id'])
+        return c
+    return None
+
+
+def _container_not_found(ip):
+    # Try to find the container over the mesos state api and use the labels attached to it
+    # as a replacement for docker env and labels
+    if app.config['MESOS_STATE_LOOKUP']:
+        mesos_container = find_mesos_container(ip)
+        if mesos_container is not None:
+            return mesos_container
 
     log.error('No container found for ip {0}'.format(ip))
     return None
 
 
-@cached(cache=TTLCache(maxsize=512, ttl=60))
+def _hostname_key(fqdn):
+    """Return the first HOSTNAME_MATCH_REGEX group of fqdn, which identifies
+    the host for FQDN matching, or None if it doesn't match."""
+    if not fqdn:
+        return None
+    m = RE_HOSTNAME_MATCH.match(fqdn)
+    if m is None or not m.groups():
+        return None
+    return m.group(1)
+
+
+def _container_hostname_key(container):
+    config = container['Config']
+    return _hostname_key('{0}.{1}'.format(config['Hostname'], config['Domainname']))
+
+
+def _index_container_hostname(container):
+    """Add a container to HOSTNAME_INDEX, and return its hostname key."""
+    if not app.config['ROLE_REVERSE_LOOKUP']:
+        return None
+    key = _container_hostname_key(container)
+    container_id = container['Id']
+    previous_key = CONTAINER_HOSTNAME_KEYS.get(container_id)
+    if previous_key is not None and previous_key != key:
+        _forget_container_hostname(container_id)
+    if key is not None:
+        HOSTNAME_INDEX[key] = container_id
+        CONTAINER_HOSTNAME_KEYS[container_id] = key
+    return key
+
+
+def _forget_container_hostname(container_id):
+    key = CONTAINER_HOSTNAME_KEYS.pop(container_id, None)
+    if key is not None and HOSTNAME_INDEX.get(key) == container_id:
+        del HOSTNAME_INDEX[key]
+
+
+def _find_container_by_hostname(client, ip, hostname_key):
+    container_id = HOSTNAME_INDEX.get(hostname_key) if hostname_key else None
+    if not container_id:
+        return None
+    try:
+        with PrintingBlockTimer('Container inspect'):
+            container = client.inspect_container(container_id)
+    except docker.errors.NotFound:
+        container = None
+    # Check the indexed container is still the right one.
+    if container is None or not container['State']['Running'] or \
+            _container_hostname_key(container) != hostname_key:
+        _forget_container_hostname(container_id)
+        return None
+    msg = 'Container id {0} mapped to {1} by FQDN match'
+    log.debug(msg.format(container_id, ip))
+    _map_container(ip, container_id)
+    return container
+
+
+def _map_container(ip, container_id):
+    previous_id = CONTAINER_MAPPING.get(ip)
+    if previous_id and previous_id != container_id:
+        _forget_container(previous_id)
+    CONTAINER_MAPPING[ip] = container_id
+    if SHARED_CONTAINERS:
+        expires_at = time.time() + app.config['SHARED_CACHE_CONTAINER_TTL']
+        SHARED_CONTAINERS.set(ip, container_id, expires_at)
+
+
+def _unmap_container(ip):
+    container_id = CONTAINER_MAPPING.pop(ip, None)
+    if container_id:
+        metrics.incr('cache_evictions', cache='container_mapping')
+        _forget_container(container_id)
+    if SHARED_CONTAINERS:
+        SHARED_CONTAINERS.delete(ip)
+
+
+def _container_started(container):
+    if app.config['ROLE_PREWARM']:
+        PREWARMER.submit(container)
+
+
+def _prewarm_container(container):
+    """Assume a newly started container's role before it asks for it."""
+    role_params = get_role_params_from_container(container)
+    if not role_params['name']:
+        return 'no_role'
+    arn = get_role_arn(role_params)
+    get_assumed_role(role_params, prewarm=True)
+    PREWARMED_ROLES[arn] = True
+    return 'warmed'
+
+
+def _count_prewarmed_request(arn, hit):
+    """Count whether the first request for a pre-warmed role was a cache hit."""
+    if PREWARMED_ROLES and PREWARMED_ROLES.pop(arn, None):
+        metrics.incr('prewarm_first_requests', result='hit' if hit else 'miss')
+
+
+def _forget_container(container_id):
+    if CONTAINER_ROLE_PARAMS.pop(container_id, None) is not None:
+        metrics.incr('cache_evictions', cache='role_params')
+    _forget_container_hostname(container_id)
+
+
 @log_exec_time
 def find_mesos_container(ip):
-    mesos_state_url = app.config['MESOS_STATE_URL']
-    try:
-        state = requests.get(mesos_state_url, timeout=app.config['MESOS_STATE_TIMEOUT']).json()
-        for framework in state['frameworks']:
-            for executor in framework['executors']:
-                for task in executor['tasks']:
-                    for status in task['statuses']:
-                        if status['state'] == 'TASK_RUNNING':
-                            for network in status['container_status']['network_infos']:
-                                for ip_map in network['ip_addresses']:
-                                    if ip_map['ip_address'] == ip:
-                                        if 'labels' in task:
-                                            env = []
-                                            for label in task['labels']:
-                                                key = label['key']
-                                                val = label['value']
-                                                env_var = '{0}={1}'.format(key, val)
-                                                env.append(env_var)
-                                            container = {'Config': {'Env': env, 'Labels': env}}
-                                            return container
-
-    except requests.exceptions.Timeout:
-        log.error('Timeout when trying to call the mesos http api: {0}'.format(mesos_state_url))
-    except requests.exceptions.RequestException:
-        log.exception('Error while trying to call the mesos http api: {0}'.format(mesos_state_url))
-    except KeyError:
-        log.exception('Error while trying to lookup the required keys in the json object')
-    return None
+    return MESOS_STATE.lookup(ip)
+
+
+def start_background_workers():
+    if app.config['METRICS_PORT']:
+        metrics.serve(
+            app.config['METRICS_HOST'],
+            app.config['METRICS_PORT'],
+            port_range=app.config['METRICS_PORT_RANGE']
+        )
+    if app.config['ROLE_MAPPING_FILE']:
+        ROLE_MAPPINGS.start()
+    if app.config['CONTAINER_INDEX'] and not app.config['ROLE_MAPPING_FILE']:
+        CONTAINER_INDEX.start()
+    elif app.config['ROLE_PREWARM']:
+        log.warning('ROLE_PREWARM needs CONTAINER_INDEX to see container starts; not pre-warming')
+    if app.config['CONTAINER_MAPPING_SNAPSHOT_FILE'] and not app.config['ROLE_MAPPING_FILE']:
+        CONTAINER_MAPPING_SNAPSHOT.load()
+        CONTAINER_MAPPING_SNAPSHOT.start()
+    if app.config['ROLE_BACKGROUND_REFRESH']:
+        ROLE_REFRESHER.start()
+    if app.config['MESOS_STATE_LOOKUP']:
+        MESOS_STATE.start()
 
 
 def split_envvar(envvar):
@@ -232,145 +664,420 @@ def split_envvar(envvar):
     return (envvar.split('=', 1) + [None])[:2]
 
 
-@log_exec_time
-def get_role_params_from_ip(ip, requested_role=None):
-    params = {'name': None, 'account_id': None, 'external_id': None, 'session_name': None}
-    role_name = None
-    if app.config['ROLE_MAPPING_FILE']:
-        role = ROLE_MAPPINGS.get(ip, app.config['DEFAULT_ROLE'])
-        if isinstance(role, dict):
-            params.update(role)
-        else:
-            role_name = role
-    else:
-        container = find_container(ip)
-        if container:
-            env = container['Config']['Env'] or []
-            # Look up IAM_ROLE and IAM_EXTERNAL_ID values from environment
-            for e in env:
-                key, val = split_envvar(e)
-                if key == 'IAM_ROLE':
-                    m = RE_IAM_ARN.match(val)
-                    if m:
-                        val = '{0}@{1}'.format(m.group(2), m.group(1))
-                    role_name = val
-                elif key == 'IAM_EXTERNAL_ID':
-                    params['external_id'] = val
-            if not role_name:
-                msg = "Couldn't find IAM_ROLE variable. Returning DEFAULT_ROLE: {0}"
-                log.debug(msg.format(app.config['DEFAULT_ROLE']))
-                role_name = app.config['DEFAULT_ROLE']
-
-            # Optionally, look up role session name from environment or labels
-            if app.config['ROLE_SESSION_KEY']:
-                skey = app.config['ROLE_SESSION_KEY']
-                sval = None
-                if skey.startswith('Env:'):
-                    skey = skey[4:]
-                    for e in env:
-                        key, val = split_envvar(e)
-                        if skey == key:
-                            sval = val
-                elif skey.startswith('Labels:'):
-                    skey = skey[7:]
-                    if container['Config']['Labels'] and skey in container['Config']['Labels']:
-                        sval = container['Config']['Labels'][skey]
-                if sval and len(sval) > 1:
-                    # The docs on RoleSessionName are slightly contradictory, and state:
-                    # > The regex used to validate this parameter is a string of characters consisting
-                    # > of upper- and lower-case alphanumeric characters with no spaces. You can also
-                    # > include underscores or any of the following characters: =,.@-
-                    # > Type: String
-                    # > Length Constraints: Minimum length of 2. Maximum length of 64.
-                    # > Pattern: [\w+=,.@-]*
-                    # We replace any invalid chars with underscore, and trim to 64.
-                    params['session_name'] = re.sub(r'[^\w+=,.@-]', '_', sval)[:64]
+def _empty_role_params():
+    return {'name': None, 'account_id': None, 'external_id': None, 'session_name': None}
+
+
+def _set_role_name(params, role_name):
     if role_name:
         role_parts = role_name.split('@')
         params['name'] = role_parts[0]
         if len(role_parts) > 1:
             params['account_id'] = role_parts[1]
 
+
+@log_exec_time
+def get_role_params_from_ip(ip, requested_role=None):
+    if app.config['ROLE_MAPPING_FILE']:
+        params = get_role_params_from_mapping(ip)
+    else:
+        params = get_cached_role_params(ip)
+        if params is None:
+            try:
+                budget = stale_lookup_budget(ip)
+                container = find_container(ip, mapped_client=stale_docker_client() if budget else None)
+            except DOCKER_ERRORS:
+                params = get_stale_role_params(ip)
+                if params is None:
+                    raise
+            else:
+                params = get_role_params_from_container(container)
+
     if requested_role and requested_role != params['name']:
         raise UnexpectedRoleError
 
     return params
 
 
-@log_exec_time
-def get_role_info_from_params(role_params):
+def get_role_params_from_mapping(ip):
+    params = _empty_role_params()
+    role = ROLE_MAPPINGS.get(ip, app.config['DEFAULT_ROLE'])
+    if isinstance(role, dict):
+        params.update(role)
+    else:
+        _set_role_name(params, role)
+    return params
+
+
+def get_cached_role_params(ip):
+    """Return the cached role params for the container with this IP, if the
+    container index vouches that it's running.
+
+    This needs no docker calls, so it's only used while the index is synced;
+    otherwise the IP's container has to be found (and inspected, to check it
+    is still running) with find_container.
+    """
+    if not CONTAINER_INDEX.synced:
+        return None
+    container_id = CONTAINER_INDEX.lookup(ip)
+    params = CONTAINER_ROLE_PARAMS.get(container_id)
+    if params is None:
+        return None
+    metrics.incr('cache_lookups', cache='role_params', result='hit')
+    return dict(params)
+
+
+def stale_lookup_budget(ip):
+    """With SERVE_STALE, if the role params of the container mapped to ip
+    are cached, return how long, in seconds, docker gets to confirm that the
+    container is still running before they're served stale instead; and
+    otherwise None.
+
+    Raises CircuitOpenError while the docker circuit breaker isn't closed, to
+    serve the stale params straight away and leave trial calls to the
+    background revalidation.
+    """
+    if not app.config['SERVE_STALE'] or not app.config['SERVE_STALE_DOCKER_TIMEOUT']:
+        return None
+    container_id = CONTAINER_MAPPING.get(ip)
+    if not container_id or CONTAINER_ROLE_PARAMS.get(container_id) is None:
+        return None
+    if DOCKER_BREAKER.state != CLOSED:
+        raise CircuitOpenError('Circuit breaker for docker is open')
+    return app.config['SERVE_STALE_DOCKER_TIMEOUT']
+
+
+def get_stale_role_params(ip):
+    """With SERVE_STALE, return the cached role params of the container last
+    mapped to ip, for when docker fails, or doesn't answer within
+    SERVE_STALE_DOCKER_TIMEOUT, while the container is looked up.
+
+    The container's mapping is revalidated in the background. Stale params
+    are only served when docker fails, so a mapping that docker says is
+    out of date is never served.
+    """
+    if not app.config['SERVE_STALE']:
+        return None
+    container_id = CONTAINER_MAPPING.get(ip)
+    params = CONTAINER_ROLE_PARAMS.get(container_id) if container_id else None
+    if params is None:
+        return None
+    log.warning('Docker is unavailable; serving cached role params for {0}'.format(ip))
+    metrics.incr('stale_served', source='docker')
+    STALE_CONTAINERS.submit(ip, lambda: find_container(ip), time.time() + STALE_CONTAINER_RETRY_WINDOW)
+    return dict(params)
+
+
+def get_role_params_from_container(container):
+    """Get role params from a container's env and labels.
+
+    `container` is an inspected container, as returned by find_container, or
+    None. Params are parsed once per container ID, and forgotten when the
+    container stops or its IP is mapped to another container. Callers get a
+    copy they're free to modify.
+    """
+    if not container:
+        return _empty_role_params()
+    container_id = container.get('Id')
+    if container_id:
+        params = CONTAINER_ROLE_PARAMS.get(container_id)
+        if params is not None:
+            metrics.incr('cache_lookups', cache='role_params', result='hit')
+            return dict(params)
+        metrics.incr('cache_lookups', cache='role_params', result='miss')
+    params = _parse_role_params(container)
+    if container_id:
+        CONTAINER_ROLE_PARAMS[container_id] = params
+    return dict(params)
+
+
+def _parse_role_params(container):
+    params = _empty_role_params()
+    role_name = None
+    env = container['Config']['Env'] or []
+    # Look up IAM_ROLE and IAM_EXTERNAL_ID values from environment
+    for e in env:
+        key, val = split_envvar(e)
+        if key == 'IAM_ROLE':
+            m = RE_IAM_ARN.match(val)
+            if m:
+                val = '{0}@{1}'.format(m.group(2), m.group(1))
+            role_name = val
+        elif key == 'IAM_EXTERNAL_ID':
+            params['external_id'] = val
+    if not role_name:
+        msg = "Couldn't find IAM_ROLE variable. Returning DEFAULT_ROLE: {0}"
+        log.debug(msg.format(app.config['DEFAULT_ROLE']))
+        role_name = app.config['DEFAULT_ROLE']
+
+    # Optionally, look up role session name from environment or labels
+    if app.config['ROLE_SESSION_KEY']:
+        skey = app.config['ROLE_SESSION_KEY']
+        sval = None
+        if skey.startswith('Env:'):
+            skey = skey[4:]
+            for e in env:
+                key, val = split_envvar(e)
+                if skey == key:
+                    sval = val
+        elif skey.startswith('Labels:'):
+            skey = skey[7:]
+            if container['Config']['Labels'] and skey in container['Config']['Labels']:
+                sval = container['Config']['Labels'][skey]
+        if sval and len(sval) > 1:
+            # The docs on RoleSessionName are slightly contradictory, and state:
+            # > The regex used to validate this parameter is a string of characters consisting
+            # > of upper- and lower-case alphanumeric characters with no spaces. You can also
+            # > include underscores or any of the following characters: =,.@-
+            # > Type: String
+            # > Length Constraints: Minimum length of 2. Maximum length of 64.
+            # > Pattern: [\w+=,.@-]*
+            # We replace any invalid chars with underscore, and trim to 64.
+            params['session_name'] = re.sub(r'[^\w+=,.@-]', '_', sval)[:64]
+    _set_role_name(params, role_name)
+    return params
+
+
+def _assumed_role_for_info(role_params):
     if not role_params['name']:
-        return {}
+        return None
     try:
-        role = get_assumed_role(role_params)
+        return get_assumed_role(role_params)
     except GetRoleError:
+        return None
+
+
+@log_exec_time
+def get_role_info_from_params(role_params):
+    role = _assumed_role_for_info(role_params)
+    if role is None:
         return {}
+    return role_info(role)
+
+
+@log_exec_time
+def get_role_info_json_from_params(role_params):
+    """Like get_role_info_from_params, but return the serialized response."""
+    role = _assumed_role_for_info(role_params)
+    if role is None:
+        return render_json({})
+    return role_info_json(get_role_arn(role_params), role)
+
+
+def role_info(assumed_role):
     time_format = "%Y-%m-%dT%H:%M:%SZ"
-    expiration = role['Credentials']['Expiration']
+    expiration = assumed_role['Credentials']['Expiration']
     updated = expiration - datetime.timedelta(minutes=60)
     return {
         'Code': 'Success',
         'LastUpdated': updated.strftime(time_format),
-        'InstanceProfileArn': role['AssumedRoleUser']['Arn'],
-        'InstanceProfileId': role['AssumedRoleUser']['AssumedRoleId']
+        'InstanceProfileArn': assumed_role['AssumedRoleUser']['Arn'],
+        'InstanceProfileId': assumed_role['AssumedRoleUser']['AssumedRoleId']
     }
 
 
-def get_role_arn(role_params):
+def _generated_role_arn(role_params):
+    """Return the role's ARN, if it can be generated without calling IAM."""
     if role_params['account_id']:
         # Try to map the name to an account ID. If it isn't found, assume an ID was passed
         # in and use it as-is.
-        role_params['account_id'] = app.config['AWS_ACCOUNT_MAP'].get(
+        account_id = app.config['AWS_ACCOUNT_MAP'].get(
             role_params['account_id'],
             role_params['account_id']
         )
+    elif app.config['DEFAULT_ACCOUNT_ID']:
+        account_id = app.config['DEFAULT_ACCOUNT_ID']
     else:
-        if app.config['DEFAULT_ACCOUNT_ID']:
-            role_params['account_id'] = app.config['DEFAULT_ACCOUNT_ID']
-        # No default account id defined. Get the ARN by looking up the role
-        # name. This is a backwards compat use-case for when we didn't require
-        # the default account id.
-        else:
-            iam = iam_client()
-            try:
-                with PrintingBlockTimer('iam.get_role'):
-                    if '/' in role_params['name']:
-                        path, name = role_params['name'].rsplit('/', 1)
-                        role = iam.get_role(Path=path + '/', RoleName=name)
-                    else:
-                        role = iam.get_role(RoleName=role_params['name'])
-                    return role['Role']['Arn']
-            except ClientError as e:
-                response = e.response['ResponseMetadata']
-                raise GetRoleError((response['HTTPStatusCode'], e.message))
-    # Return a generated ARN
-    return 'arn:aws:iam::{account_id}:role/{name}'.format(**role_params)
+        return None
+    return 'arn:aws:iam::{0}:role/{1}'.format(account_id, role_params['name'])
+
+
+def get_role_arn(role_params):
+    arn = _generated_role_arn(role_params)
+    if arn:
+        return arn
+    # No account id or default account id defined. Get the ARN by looking up
+    # the role name. This is a backwards compat use-case for when we didn't
+    # require the default account id. Lookups are cached, including for role
+    # names IAM doesn't know, and concurrent lookups of a name are coalesced.
+    name = role_params['name']
+    with _iam_role_arns_lock:
+        arn = IAM_ROLE_ARNS.get(name)
+        error = IAM_ROLE_ERRORS.get(name)
+    if arn:
+        metrics.incr('cache_lookups', cache='iam_role_arns', result='hit')
+        return arn
+    if error:
+        metrics.incr('cache_lookups', cache='iam_role_arns', result='negative_hit')
+        raise GetRoleError(error)
+    metrics.incr('cache_lookups', cache='iam_role_arns', result='miss')
+    return IAM_GET_ROLE_FLIGHTS.do(name, _get_role_arn, name)
+
+
+def _get_role_arn(role_name):
+    iam = iam_client()
+    try:
+        with PrintingBlockTimer('iam.get_role'):
+            if '/' in role_name:
+                path, name = role_name.rsplit('/', 1)
+                role = iam.get_role(Path=path + '/', RoleName=name)
+            else:
+                role = iam.get_role(RoleName=role_name)
+    except ClientError as e:
+        response = e.response['ResponseMetadata']
+        error = (response['HTTPStatusCode'], e.response.get('Error', {}).get('Message', str(e)))
+        if e.response.get('Error', {}).get('Code') == 'NoSuchEntity':
+            with _iam_role_arns_lock:
+                IAM_ROLE_ERRORS[role_name] = error
+        raise GetRoleError(error)
+    arn = role['Role']['Arn']
+    with _iam_role_arns_lock:
+        IAM_ROLE_ARNS[role_name] = arn
+    return arn
+
+
+def _is_fresh(assumed_role):
+    """Check the role isn't yet inside ROLE_EXPIRATION_THRESHOLD."""
+    expiration = assumed_role['Credentials']['Expiration']
+    now = datetime.datetime.now(dateutil.tz.tzutc())
+    expire_check = now + datetime.timedelta(minutes=app.config['ROLE_EXPIRATION_THRESHOLD'])
+    return expire_check < expiration
+
+
+def get_cached_assumed_role(role_params):
+    """Return the assumed role for role_params if it's cached and fresh.
+
+    Unlike get_assumed_role this never calls IAM or STS, so it's safe to call
+    from an event loop. None means get_assumed_role has to be called.
+    """
+    arn = _generated_role_arn(role_params)
+    assumed_role = ROLES.get(arn)
+    if assumed_role is None or not _is_fresh(assumed_role):
+        return None
+    ROLE_REFRESHER.touch(arn)
+    metrics.incr('cache_lookups', cache='roles', result='hit')
+    _count_prewarmed_request(arn, True)
+    return assumed_role
 
 
 @log_exec_time
-def get_assumed_role(role_params):
+def get_assumed_role(role_params, prewarm=False):
     arn = get_role_arn(role_params)
-    if arn in ROLES:
-        assumed_role = ROLES[arn]
-        expiration = assumed_role['Credentials']['Expiration']
-        now = datetime.datetime.now(dateutil.tz.tzutc())
-        expire_check = now + datetime.timedelta(minutes=app.config['ROLE_EXPIRATION_THRESHOLD'])
-        if expire_check < expiration:
+    assumed_role = ROLES.get(arn)
+    if prewarm:
+        # Pre-warming isn't a use of the role, so isn't counted as one.
+        if assumed_role is not None and _is_fresh(assumed_role):
             return assumed_role
-    with PrintingBlockTimer('sts.assume_role'):
-        sts = sts_client()
-        session_name = role_params['session_name'] or 'devproxyauth'
-        kwargs = {'RoleArn': arn, 'RoleSessionName': session_name}
-        if role_params['external_id']:
-            kwargs['ExternalId'] = role_params['external_id']
-        assumed_role = sts.assume_role(**kwargs)
+    elif assumed_role is not None:
+        ROLE_REFRESHER.touch(arn)
+        fresh = _is_fresh(assumed_role)
+        _count_prewarmed_request(arn, fresh)
+        if fresh:
+            metrics.incr('cache_lookups', cache='roles', result='hit')
+            return assumed_role
+        metrics.incr('cache_lookups', cache='roles', result='expiring')
+    else:
+        _count_prewarmed_request(arn, False)
+        metrics.incr('cache_lookups', cache='roles', result='miss')
+    session_name = role_params['session_name'] or 'devproxyauth'
+    kwargs = {'RoleArn': arn, 'RoleSessionName': session_name}
+    if role_params['external_id']:
+        kwargs['ExternalId'] = role_params['external_id']
+    # A cached role that isn't fresh is still valid, since expired roles are
+    # evicted from ROLES, so re-assuming it is a refresh.
+    refresh = assumed_role is not None
+    if refresh and app.config['SERVE_STALE']:
+        # Serve the still-valid role now, and refresh it in the background.
+        metrics.incr('stale_served', source='sts')
+        expires_at = assumed_role['Credentials']['Expiration'].timestamp()
+        STALE_ROLES.submit(arn, lambda: assume_role(kwargs, refresh=True), expires_at)
+        return assumed_role
+    try:
+        return assume_role(kwargs, refresh=refresh)
+    except (StsThrottledError, CircuitOpenError):
+        if not refresh:
+            raise
+        log.warning('STS is unavailable; serving still-valid credentials for {0}'.format(arn))
+        return assumed_role
+
+
+def assume_role(kwargs, refresh=False):
+    """Call sts.assume_role and cache the result in ROLES.
+
+    Concurrent calls with the same assume-role parameters are coalesced into
+    a single STS call, and with a shared cache, a role another worker has
+    already assumed is reused. When background refresh is enabled, the role
+    is also scheduled to be re-assumed before it falls inside
+    ROLE_EXPIRATION_THRESHOLD, so that requests don't have to wait on STS to
+    refresh it.
+
+    STS calls go through STS_LIMITER; `refresh` marks a call that refreshes
+    a role that's still valid, which the limiter gives a lower priority.
+    Calls it doesn't admit raise StsThrottledError.
+    """
+    key = tuple(sorted(kwargs.items()))
+    return ASSUME_ROLE_FLIGHTS.do(key, _assume_role, key, kwargs, refresh)
+
+
+def _assume_role(key, kwargs, refresh):
+    arn = kwargs['RoleArn']
+    if SHARED_ROLES:
+        # Shared roles are kept by role ARN, like ROLES, so that a role
+        # assumed with new parameters replaces the previous one.
+        with SHARED_ROLES.lock(arn):
+            assumed_role = _shared_assumed_role(key, arn)
+            if assumed_role is None:
+                assumed_role = _call_assume_role(kwargs, refresh)
+                expires_at = assumed_role['Credentials']['Expiration'].timestamp()
+                SHARED_ROLES.set(arn, (key, assumed_role), expires_at)
+    else:
+        assumed_role = _call_assume_role(kwargs, refresh)
     ROLES[arn] = assumed_role
+    if app.config['ROLE_BACKGROUND_REFRESH']:
+        expiration = assumed_role['Credentials']['Expiration']
+        threshold = datetime.timedelta(minutes=app.config['ROLE_EXPIRATION_THRESHOLD'])
+        ROLE_REFRESHER.track(arn, (kwargs,), (expiration - threshold).timestamp())
     return assumed_role
 
 
+def _shared_assumed_role(key, arn):
+    """Return a role assumed by another worker with the same parameters, if
+    it's newer than ours and isn't yet inside ROLE_EXPIRATION_THRESHOLD."""
+    shared = SHARED_ROLES.get(arn)
+    if shared is None or shared[0] != key:
+        return None
+    assumed_role = shared[1]
+    expiration = assumed_role['Credentials']['Expiration']
+    cached_role = ROLES.get(arn)
+    if cached_role is not None and expiration <= cached_role['Credentials']['Expiration']:
+        return None
+    now = datetime.datetime.now(dateutil.tz.tzutc())
+    if now + datetime.timedelta(minutes=app.config['ROLE_EXPIRATION_THRESHOLD']) >= expiration:
+        return None
+    return assumed_role
+
+
+def _call_assume_role(kwargs, refresh=False):
+    def call():
+        with PrintingBlockTimer('sts.assume_role'):
+            sts = sts_client()
+            return sts.assume_role(**kwargs)
+    return STS_LIMITER.call(call, refresh=refresh)
+
+
 @log_exec_time
 def get_assumed_role_credentials(role_params, api_version='latest'):
+    return role_credentials(get_assumed_role(role_params))
+
+
+@log_exec_time
+def get_assumed_role_credentials_json(role_params):
+    """Like get_assumed_role_credentials, but return the serialized response."""
     assumed_role = get_assumed_role(role_params)
+    return role_credentials_json(get_role_arn(role_params), assumed_role)
+
+
+def role_credentials(assumed_role):
     time_format = "%Y-%m-%dT%H:%M:%SZ"
     credentials = assumed_role['Credentials']
     expiration = credentials['Expiration']
@@ -386,6 +1093,46 @@ def get_assumed_role_credentials(role_params, api_version='latest'):
     }
 
 
+def render_json(data):
+    # Serialized the same way as flask's jsonify.
+    return (json.dumps(data, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def _rendered_role_response(arn, assumed_role, render):
+    """Return render(assumed_role) as JSON, serializing it only once per
+    assumed role.
+
+    A refreshed role is a new object in ROLES, so its responses are rendered
+    again the first time they're requested, replacing those of the role
+    assumed before it.
+    """
+    key = (arn, render.__name__)
+    rendered = ROLE_RESPONSES.get(key)
+    if rendered is not None and rendered[0] is assumed_role:
+        metrics.incr('cache_lookups', cache='role_responses', result='hit')
+        return rendered[1]
+    metrics.incr('cache_lookups', cache='role_responses', result='miss')
+    body = render_json(render(assumed_role))
+    ROLE_RESPONSES[key] = (assumed_role, body)
+    return body
+
+
+def _forget_role(arn, assumed_role):
+    """Clean up after a role is evicted from ROLES."""
+    ROLE_REFRESHER.forget(arn)
+    PREWARMED_ROLES.pop(arn, None)
+    for render in (role_info, role_credentials):
+        ROLE_RESPONSES.pop((arn, render.__name__), None)
+
+
+def role_info_json(arn, assumed_role):
+    return _rendered_role_response(arn, assumed_role, role_info)
+
+
+def role_credentials_json(arn, assumed_role):
+    return _rendered_role_response(arn, assumed_role, role_credentials)
+
+
 class GetRoleError(Exception):
     pass
 
@@ -4,9 +4,10 @@ import requests
 from flask import Response
 from flask import request
 from flask import stream_with_context
-from flask import jsonify
 
 from metadataproxy import app
+from metadataproxy import imds
+from metadataproxy import metrics
 from metadataproxy import roles
 
 log = logging.getLogger(__name__)
@@ -23,6 +24,43 @@ def _supports_iam(version):
     return version >= '2012-01-12'
 
 
+@app.before_request
+def check_imds_token():
+    if request.endpoint == 'imds_token':
+        return None
+    if not imds.token_allowed(request.headers.get(imds.TOKEN_HEADER), request.remote_addr):
+        return '', 401
+    return None
+
+
+@app.errorhandler(roles.CircuitOpenError)
+def circuit_open(e):
+    log.error('{0}; returning 503.'.format(e))
+    return '', 503
+
+
+@app.after_request
+def count_request(response):
+    metrics.incr('requests', endpoint=request.endpoint or 'none', status=response.status_code)
+    return response
+
+
+@app.route('/<api_version>/api/token', methods=['PUT'])
+def imds_token(api_version):
+    try:
+        ttl = int(request.headers.get(imds.TOKEN_TTL_HEADER, ''))
+    except ValueError:
+        return '', 400
+    if not 1 <= ttl <= imds.MAX_TOKEN_TTL:
+        return '', 400
+    token = imds.issue_token(request.remote_addr, ttl)
+    return Response(
+        token,
+        content_type='text/plain',
+        headers={imds.TOKEN_TTL_HEADER: str(ttl)}
+    )
+
+
 @app.route('/<api_version>/meta-data/iam/info', strict_slashes=False)
 @app.route('/<api_version>/meta-data/iam/info/<path:junk>')
 def iam_role_info(api_version, junk=None):
@@ -32,7 +70,12 @@ def iam_role_info(api_version, junk=None):
     role_params_from_ip = roles.get_role_params_from_ip(request.remote_addr)
     if role_params_from_ip['name']:
         log.debug('Providing IAM role info for {0}'.format(role_params_from_ip['name']))
-        return jsonify(roles.get_role_info_from_params(role_params_from_ip))
+        try:
+            info = roles.get_role_info_json_from_params(role_params_from_ip)
+        except roles.StsThrottledError:
+            log.error('STS is throttled; returning 503.')
+            return '', 503
+        return Response(info, mimetype='application/json')
     else:
         log.error('Role name not found; returning 404.')
         return '', 404
@@ -68,23 +111,56 @@ def iam_sts_credentials(api_version, requested_role):
         return '', 404
 
     log.debug('Providing assumed role credentials for {0}'.format(role_params['name']))
-    assumed_role = roles.get_assumed_role_credentials(
-        role_params=role_params,
-        api_version=api_version
-    )
-    return jsonify(assumed_role)
+    try:
+        credentials = roles.get_assumed_role_credentials_json(role_params)
+    except roles.StsThrottledError:
+        log.error('STS is throttled; returning 503.')
+        return '', 503
+    return Response(credentials, mimetype='application/json')
+
+
+def _stream(req):
+    # Make sure the upstream response is closed even if the client goes away
+    # mid-stream, so its connection goes back to the pool.
+    try:
+        for chunk in req.iter_content(chunk_size=8192):
+            yield chunk
+    finally:
+        req.close()
 
 
 @app.route('/<path:url>')
 @app.route('/')
 def passthrough(url=''):
     log.debug('Did not match credentials request url; passing through.')
-    req = requests.get(
-        '{0}/{1}'.format(app.config['METADATA_URL'], url),
-        stream=True
-    )
+    path = url.lstrip('/')
+    try:
+        ttl = imds.RESPONSE_CACHE.ttl_for(path)
+        if ttl:
+            cached = imds.RESPONSE_CACHE.get(path)
+            if cached is None:
+                req = imds.get(url)
+                cached = imds.CachedResponse(
+                    req.status_code,
+                    req.headers['content-type'],
+                    req.content
+                )
+                if req.status_code == 200:
+                    imds.RESPONSE_CACHE.set(path, ttl, cached)
+            return Response(
+                cached.body,
+                content_type=cached.content_type,
+                status=cached.status
+            )
+        req = imds.get(url, stream=True)
+    except requests.exceptions.Timeout:
+        log.error('Timeout when proxying {0} to the metadata service'.format(url))
+        return '', 504
+    except requests.exceptions.ConnectionError:
+        log.exception('Error when proxying {0} to the metadata service'.format(url))
+        return '', 502
     return Response(
-        stream_with_context(req.iter_content()),
+        stream_with_context(_stream(req)),
         content_type=req.headers['content-type'],
         status=req.status_code
     )
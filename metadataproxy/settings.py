@@ -59,6 +59,10 @@ DEBUG = bool_env('DEBUG', False)
 
 # Url of the docker daemon. The default is to access docker via its socket.
 DOCKER_URL = str_env('DOCKER_URL', 'unix://var/run/docker.sock')
+# Timeout, in seconds, for calls to the docker daemon, and how many times to
+# retry calls that fail to connect or time out.
+DOCKER_TIMEOUT = float_env('DOCKER_TIMEOUT', 5)
+DOCKER_RETRIES = int_env('DOCKER_RETRIES', 1)
 # URL of the metadata service. Default is the normal location of the
 # metadata service in AWS.
 METADATA_URL = str_env('METADATA_URL', 'http://169.254.169.254')
@@ -66,6 +70,42 @@ METADATA_URL = str_env('METADATA_URL', 'http://169.254.169.254')
 # returned to callers. If False, all endpoints except for IAM endpoints will be
 # proxied through to the real metadata service.
 MOCK_API = bool_env('MOCK_API', False)
+# Maximum number of keep-alive connections to the metadata service to pool
+# per worker.
+METADATA_POOL_SIZE = int_env('METADATA_POOL_SIZE', 10)
+# Whether to keep connections to the metadata service alive between requests.
+METADATA_KEEPALIVE = bool_env('METADATA_KEEPALIVE', True)
+# Connect and read timeouts, in seconds, for requests to the metadata service.
+METADATA_CONNECT_TIMEOUT = float_env('METADATA_CONNECT_TIMEOUT', 1)
+METADATA_READ_TIMEOUT = float_env('METADATA_READ_TIMEOUT', 5)
+# Use an IMDSv2 session token for requests to the metadata service. A single
+# token is shared by all requests, and renewed before it expires. If the
+# metadata service doesn't issue tokens, IMDSv1 is used.
+METADATA_UPSTREAM_TOKEN = bool_env('METADATA_UPSTREAM_TOKEN', True)
+# TTL, in seconds, to request for the shared upstream IMDSv2 token.
+METADATA_TOKEN_TTL = int_env('METADATA_TOKEN_TTL', 21600)
+# Secret used to sign IMDSv2 session tokens issued to containers. All
+# processes serving the same clients must share it; run-server.sh generates
+# one for its gunicorn workers if it isn't set. If unset, the first worker
+# generates one, and stores it in SHARED_CACHE_DIR, or a directory private to
+# the current user in the system temp directory, for the others to use.
+IMDS_TOKEN_SECRET = str_env('IMDS_TOKEN_SECRET').encode('utf-8')
+# Reject requests that don't carry an IMDSv2 session token with a 401, like
+# an instance with IMDSv2 required.
+IMDS_REQUIRE_TOKEN = bool_env('IMDS_REQUIRE_TOKEN', False)
+# A mapping of path regexes to TTLs in seconds. Successful passthrough
+# responses for matching paths are cached, and served from memory until they
+# expire. Paths are matched without a leading slash, e.g. latest/meta-data/ami-id.
+# Set to {} to disable caching.
+PASSTHROUGH_CACHE_PATTERNS = json.loads(str_env(
+    'PASSTHROUGH_CACHE_PATTERNS',
+    json.dumps({
+        r'^[^/]+/meta-data/(ami-id|ami-launch-index|ami-manifest-path|instance-id|instance-type|'
+        r'local-hostname|local-ipv4|mac|reservation-id)$': 3600,
+        r'^[^/]+/meta-data/placement/': 3600,
+        r'^[^/]+/dynamic/instance-identity/': 3600
+    })
+))
 # When mocking the API, use the following instance id in returned data.
 MOCKED_INSTANCE_ID = str_env('MOCKED_INSTANCE_ID', 'mockedid')
 
@@ -88,21 +128,128 @@ DEFAULT_ACCOUNT_ID = str_env('DEFAULT_ACCOUNT_ID')
 AWS_ACCOUNT_MAP = json.loads(str_env('AWS_ACCOUNT_MAP', '{}'))
 # AWS Region to resolve region based STS service endpoint and to make calls against it.
 AWS_REGION = str_env('AWS_REGION')
+# A comma-separated list of AWS regions, e.g. us-east-1,us-west-2, whose STS
+# endpoints to spread sts:AssumeRole calls over. Each call goes to the endpoint
+# with the lowest recent latency and error rate, and fails over to the next on
+# timeouts, connection errors and 5xx responses. Takes precedence over
+# AWS_REGION for STS, and is ignored if STS_ENDPOINT_URL is set.
+STS_REGIONS = [region.strip() for region in str_env('STS_REGIONS').split(',') if region.strip()]
+# Override the STS and IAM endpoint URLs, e.g. for VPC endpoints or for local
+# stand-ins when benchmarking.
+STS_ENDPOINT_URL = str_env('STS_ENDPOINT_URL')
+IAM_ENDPOINT_URL = str_env('IAM_ENDPOINT_URL')
+# The most sts:AssumeRole calls to make per second, host-wide if
+# SHARED_CACHE_DIR is set, and how many can burst at once. The rate is cut when
+# STS throttles calls, and recovers as calls succeed. Refreshes of credentials
+# that are still valid only get the top half of the burst, so first fetches go
+# first. Set the rate to 0 to disable the limiter.
+STS_RATE_LIMIT = float_env('STS_RATE_LIMIT', 50)
+STS_RATE_BURST = int_env('STS_RATE_BURST', 100)
+# How many times to retry an sts:AssumeRole call that STS throttled, with
+# jittered exponential backoff.
+STS_THROTTLE_RETRIES = int_env('STS_THROTTLE_RETRIES', 3)
+# How long, in seconds, a first fetch of credentials waits for the STS rate
+# limiter before failing.
+STS_ADMISSION_TIMEOUT = float_env('STS_ADMISSION_TIMEOUT', 5)
+# Connect and read timeouts, in seconds, for calls to STS and IAM, and how
+# many times failed calls are retried. While STS_RATE_LIMIT is on, the rate
+# limiter retries throttled STS calls instead, and only connection errors,
+# timeouts and 5xx responses are retried this many times.
+AWS_CONNECT_TIMEOUT = float_env('AWS_CONNECT_TIMEOUT', 2)
+AWS_READ_TIMEOUT = float_env('AWS_READ_TIMEOUT', 5)
+AWS_MAX_RETRIES = int_env('AWS_MAX_RETRIES', 2)
+# After this many consecutive failed calls to docker, STS, IAM or the mesos
+# agent, fail calls to it straight away for CIRCUIT_BREAKER_RESET_TIMEOUT
+# seconds, then let a trial call through. Set to 0 to disable circuit breakers.
+CIRCUIT_BREAKER_FAILURES = int_env('CIRCUIT_BREAKER_FAILURES', 5)
+CIRCUIT_BREAKER_RESET_TIMEOUT = float_env('CIRCUIT_BREAKER_RESET_TIMEOUT', 30)
 # The threshold before credentials expire in minutes at which metadataproxy will attempt
 # to load new credentials. The default in previous versions of metadataproxy was 5, but
 # we choose to make the new default 15 for better compatibility with aws-sdk-java.
 ROLE_EXPIRATION_THRESHOLD = int_env('ROLE_EXPIRATION_THRESHOLD', 15)
-# A json file that has a dict mapping of IP addresses to role names. Can be
-# used if docker networking has been disabled and you are managing IP
-# addressing for containers through another process.
+# Serve still-valid cached answers rather than waiting on, or failing with,
+# an upstream: roles inside ROLE_EXPIRATION_THRESHOLD are served as they are
+# and refreshed in the background, and if docker fails, or is slower than
+# SERVE_STALE_DOCKER_TIMEOUT, while a container is looked up, the cached role
+# params of the container last mapped to the IP are served, and the mapping
+# revalidated in the background.
+SERVE_STALE = bool_env('SERVE_STALE', False)
+# How long, in seconds, to wait between retries of a failed background refresh
+# of a stale role or container mapping.
+SERVE_STALE_RETRY_DELAY = int_env('SERVE_STALE_RETRY_DELAY', 5)
+# With SERVE_STALE, how long, in seconds, docker gets to confirm that the
+# container mapped to an IP is still running, when its role params are
+# cached, before they're served stale. Keep this under the IMDS timeouts of
+# the AWS SDKs, which is about a second. 0 waits for DOCKER_TIMEOUT instead.
+SERVE_STALE_DOCKER_TIMEOUT = float_env('SERVE_STALE_DOCKER_TIMEOUT', 0.5)
+# The most assumed roles to keep cached. The least recently used are evicted
+# beyond this, and roles whose credentials have expired are always evicted.
+ROLE_CACHE_MAX_ENTRIES = int_env('ROLE_CACHE_MAX_ENTRIES', 1000)
+# Re-assume cached roles in the background before they fall inside
+# ROLE_EXPIRATION_THRESHOLD, so that credential requests don't wait on STS.
+ROLE_BACKGROUND_REFRESH = bool_env('ROLE_BACKGROUND_REFRESH', False)
+# Window, in seconds, before ROLE_EXPIRATION_THRESHOLD in which background
+# refreshes are randomly scheduled, so that refreshes don't cluster.
+ROLE_REFRESH_LEAD_TIME = int_env('ROLE_REFRESH_LEAD_TIME', 120)
+# Stop refreshing roles in the background that haven't been requested for
+# this many seconds.
+ROLE_REFRESH_IDLE_TIMEOUT = int_env('ROLE_REFRESH_IDLE_TIMEOUT', 7200)
+# Assume a container's role in the background as soon as the container starts,
+# so that its first credential request is served from cache. Requires
+# CONTAINER_INDEX, whose docker events stream reports container starts.
+ROLE_PREWARM = bool_env('ROLE_PREWARM', False)
+# The most containers to pre-warm credentials for at once.
+ROLE_PREWARM_CONCURRENCY = int_env('ROLE_PREWARM_CONCURRENCY', 4)
+# How long, in seconds, to cache role ARNs looked up with iam:GetRole, which is
+# only needed for roles without an account ID when DEFAULT_ACCOUNT_ID isn't
+# set, and how long to cache role names IAM doesn't know.
+IAM_ROLE_ARN_CACHE_TTL = int_env('IAM_ROLE_ARN_CACHE_TTL', 3600)
+IAM_ROLE_ARN_NEGATIVE_TTL = int_env('IAM_ROLE_ARN_NEGATIVE_TTL', 60)
+# A json file that has a dict mapping of IP addresses or CIDR ranges to role
+# names; an IP gets the role of the most specific match. Can be used if docker
+# networking has been disabled and you are managing IP addressing for
+# containers through another process.
 ROLE_MAPPING_FILE = str_env('ROLE_MAPPING_FILE')
+# How often, in seconds, to check ROLE_MAPPING_FILE for changes and reload it.
+# Set to 0 to only load it at startup.
+ROLE_MAPPING_RELOAD_INTERVAL = int_env('ROLE_MAPPING_RELOAD_INTERVAL', 5)
 # Do a reverse lookup of incoming IP addresses to match containers by hostname.
 # Useful if you've disabled networking in docker, but set hostnames for
 # containers in /etc/hosts or DNS.
 ROLE_REVERSE_LOOKUP = bool_env('ROLE_REVERSE_LOOKUP', False)
+# Keep an in-memory IP to container index, built once at startup and kept
+# current from the docker events stream, instead of scanning every container
+# when an IP isn't in the container mapping cache.
+CONTAINER_INDEX = bool_env('CONTAINER_INDEX', False)
+# Seconds to wait before reconnecting to the docker events stream (and
+# resyncing the container index) after the stream drops.
+CONTAINER_INDEX_RECONNECT_DELAY = float_env('CONTAINER_INDEX_RECONNECT_DELAY', 5)
+# How many containers to inspect at once when scanning for an IP that isn't
+# in the container mapping cache.
+CONTAINER_SCAN_CONCURRENCY = int_env('CONTAINER_SCAN_CONCURRENCY', 8)
+# When an IP isn't in the container mapping cache, find its container from
+# the container IP tables of docker's networks, with a call per network,
+# rather than by inspecting every container. IPs only set in Rancher's
+# io.rancher.container.ip label aren't in docker's networks, so can't be
+# matched this way.
+CONTAINER_NETWORK_LOOKUP = bool_env('CONTAINER_NETWORK_LOOKUP', False)
+# A local file to periodically persist the IP to container ID mapping cache
+# to, and to load it back from at startup, so that restarts don't need to
+# rescan for every container. Loaded entries are checked against docker
+# before they're used. No credentials are persisted.
+CONTAINER_MAPPING_SNAPSHOT_FILE = str_env('CONTAINER_MAPPING_SNAPSHOT_FILE')
+# How often, in seconds, to write the container mapping snapshot, if changed.
+CONTAINER_MAPPING_SNAPSHOT_INTERVAL = int_env('CONTAINER_MAPPING_SNAPSHOT_INTERVAL', 30)
 # Limit reverse lookup container matching to hostnames that match the specified
 # pattern.
 HOSTNAME_MATCH_REGEX = str_env('HOSTNAME_MATCH_REGEX', '^.*$')
+# How long, in seconds, to cache reverse lookup results, and failed reverse
+# lookups.
+REVERSE_DNS_CACHE_TTL = int_env('REVERSE_DNS_CACHE_TTL', 300)
+REVERSE_DNS_NEGATIVE_TTL = int_env('REVERSE_DNS_NEGATIVE_TTL', 30)
+# How long, in seconds, to wait on a reverse lookup before treating the IP as
+# having no name.
+REVERSE_DNS_TIMEOUT = float_env('REVERSE_DNS_TIMEOUT', 1.0)
 # Optional key in container labels or environment variables to use for role session name.
 # Prefix with Labels: or Env: respectively to indicate where key should be found.
 ROLE_SESSION_KEY = str_env('ROLE_SESSION_KEY')
@@ -112,6 +259,30 @@ MESOS_STATE_LOOKUP = bool_env('MESOS_STATE_LOOKUP', False)
 MESOS_STATE_URL = str_env('MESOS_STATE_URL', 'http://localhost:5051/state')
 # Timeout to use when calling the mesos state endpoint
 MESOS_STATE_TIMEOUT = int_env('MESOS_STATE_TIMEOUT', 2)
+# How often, in seconds, to refresh the shared snapshot of the mesos state
+MESOS_STATE_REFRESH_INTERVAL = int_env('MESOS_STATE_REFRESH_INTERVAL', 60)
+# When an IP isn't in the mesos agent state, such as a newly launched task's,
+# refresh the state if it's older than this many seconds.
+MESOS_STATE_MISS_REFRESH_INTERVAL = int_env('MESOS_STATE_MISS_REFRESH_INTERVAL', 5)
+
+# Serve Prometheus metrics on /metrics on this port. Metrics are per worker;
+# each gunicorn worker serves its own on the first free port in
+# METRICS_PORT..METRICS_PORT + METRICS_PORT_RANGE - 1. 0 disables metrics.
+METRICS_PORT = int_env('METRICS_PORT', 0)
+METRICS_PORT_RANGE = int_env('METRICS_PORT_RANGE', 16)
+# Address to serve metrics on. This should stay local-only; metrics must not
+# be reachable from containers.
+METRICS_HOST = str_env('METRICS_HOST', '127.0.0.1')
+
+# Directory for a host-local cache shared by all gunicorn workers, so that
+# roles assumed, containers resolved and mesos state fetched by one worker
+# serve all of them. It should be on a tmpfs, e.g. /dev/shm/metadataproxy, and
+# is created private to the user metadataproxy runs as, since it holds
+# credentials. If unset, each worker caches on its own.
+SHARED_CACHE_DIR = str_env('SHARED_CACHE_DIR')
+# How long, in seconds, a container resolution is kept in the shared cache.
+# Shared resolutions are still checked against docker before they're used.
+SHARED_CACHE_CONTAINER_TTL = int_env('SHARED_CACHE_CONTAINER_TTL', 3600)
 
 # Patch botocore's allowed hosts for ContainerMetadataFetcher to support aws-vault's
 # --ecs-server option. This will inject docker for mac's URL for the host into the
@@ -0,0 +1,208 @@
+# Import python libs
+import contextlib
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import time
+
+# Import metadataproxy libs
+from metadataproxy import metrics
+
+log = logging.getLogger(__name__)
+
+# How often, in seconds, to sweep expired entries out of a shared cache.
+SWEEP_INTERVAL = 60
+
+
+class SharedCache(object):
+    """A host-local cache shared by all worker processes.
+
+    Entries are stored one file per key under `directory/namespace`, which
+    should be on a tmpfs such as /dev/shm so reads and writes never touch a
+    disk. Writes are atomic renames, so readers never see a partial entry.
+    Expired entries are deleted when they're read, and by a sweep every
+    SWEEP_INTERVAL seconds, which also deletes the lock files of keys that
+    have no entry left, so the namespace doesn't grow with every key it has
+    ever held. The directory is only used if it's private to the current
+    user, since entries can hold credentials. Lookups are counted in the
+    `shared_cache_lookups` metric, labelled with the namespace.
+    """
+
+    def __init__(self, directory, namespace, lock_timeout=10):
+        self.namespace = namespace
+        self._dir = os.path.join(directory, namespace)
+        self._lock_timeout = lock_timeout
+        self._swept_at = time.time()
+        for path in (directory, self._dir):
+            try:
+                os.mkdir(path, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            st = os.stat(path)
+            if st.st_uid != os.getuid() or st.st_mode & 0o077:
+                raise ValueError('Shared cache directory {0} must be private to the current user'.format(path))
+
+    def _path(self, key, suffix=''):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self._dir, digest + suffix)
+
+    def get(self, key):
+        self._maybe_sweep()
+        path = self._path(key)
+        expires_at, value, inode = _read_entry(path)
+        if expires_at > time.time():
+            metrics.incr('shared_cache_lookups', namespace=self.namespace, result='hit')
+            return value
+        if inode is not None:
+            _unlink_entry(path, inode)
+        metrics.incr('shared_cache_lookups', namespace=self.namespace, result='miss')
+        return None
+
+    def set(self, key, value, expires_at):
+        self._maybe_sweep()
+        fd, tmp_path = tempfile.mkstemp(dir=self._dir, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((expires_at, value), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self._path(key))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except OSError:
+            pass
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """Hold a cross-process lock for `key`.
+
+        The lock is polled, rather than taken with a blocking flock, so that
+        waiting doesn't block every greenlet in the worker. If it can't be
+        taken within the lock timeout, the caller proceeds without it.
+        """
+        fd = self._acquire(self._path(key, '.lock'), self._lock_timeout)
+        if fd is None:
+            log.warning('Timed out waiting for a {0} shared cache lock'.format(self.namespace))
+        try:
+            yield fd is not None
+        finally:
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+    def _acquire(self, lock_path, timeout):
+        """Return a descriptor holding the lock at lock_path, or None if it
+        can't be taken within timeout seconds."""
+        deadline = time.time() + timeout
+        while True:
+            fd = os.open(lock_path, os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                while True:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except (IOError, OSError) as e:
+                        if e.errno not in (errno.EAGAIN, errno.EACCES):
+                            raise
+                    if time.time() >= deadline:
+                        os.close(fd)
+                        return None
+                    time.sleep(0.01)
+                # The sweep deletes lock files while holding them; if it
+                # deleted this one while we waited for it, lock the new one.
+                if os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+                    return fd
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    os.close(fd)
+                    raise
+            os.close(fd)
+
+    def _maybe_sweep(self):
+        now = time.time()
+        if now - self._swept_at < SWEEP_INTERVAL:
+            return
+        self._swept_at = now
+        try:
+            self.sweep()
+        except (IOError, OSError):
+            log.exception('Failed to sweep the {0} shared cache'.format(self.namespace))
+
+    def sweep(self):
+        """Delete expired entries, and the lock files of keys without one.
+
+        Keys whose lock is held, such as one whose entry is being written,
+        are left for the next sweep, as are temporary files that may still
+        be being written.
+        """
+        now = time.time()
+        digests = set()
+        for name in os.listdir(self._dir):
+            if name.startswith('.tmp'):
+                _unlink_if_older(os.path.join(self._dir, name), now - SWEEP_INTERVAL)
+            elif name.endswith('.lock'):
+                digests.add(name[:-len('.lock')])
+            else:
+                digests.add(name)
+        for digest in digests:
+            path = os.path.join(self._dir, digest)
+            expires_at, _, inode = _read_entry(path)
+            if expires_at > now:
+                continue
+            lock_path = path + '.lock'
+            fd = self._acquire(lock_path, 0)
+            if fd is None:
+                continue
+            try:
+                # Re-check under the lock, in case the entry was just written.
+                expires_at, _, inode = _read_entry(path)
+                if expires_at > now:
+                    continue
+                if inode is not None:
+                    _unlink_entry(path, inode)
+                os.unlink(lock_path)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+
+def _read_entry(path):
+    """Return an entry's expiry, value and inode. Entries that can't be
+    unpickled read as expired, and missing ones have no inode."""
+    try:
+        f = open(path, 'rb')
+    except (IOError, OSError):
+        return 0, None, None
+    with f:
+        inode = os.fstat(f.fileno()).st_ino
+        try:
+            expires_at, value = pickle.load(f)
+        except (EOFError, pickle.UnpicklingError, ValueError, TypeError):
+            return 0, None, inode
+    return expires_at, value, inode
+
+
+def _unlink_if_older(path, cutoff):
+    try:
+        if os.stat(path).st_mtime < cutoff:
+            os.unlink(path)
+    except OSError:
+        pass
+
+
+def _unlink_entry(path, inode):
+    # Only unlink the entry that was read, not one another worker has since
+    # written in its place.
+    try:
+        if os.stat(path).st_ino == inode:
+            os.unlink(path)
+    except OSError:
+        pass
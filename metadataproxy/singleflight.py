@@ -0,0 +1,53 @@
+# Import python libs
+import threading
+
+# Import metadataproxy libs
+from metadataproxy import metrics
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Deduplicate concurrent calls that share a key.
+
+    The first caller for a key runs the function; callers that arrive while
+    it is in flight wait for, and share, its result (or exception). Leading
+    calls and coalesced waiters are counted in the `singleflight_calls` and
+    `singleflight_coalesced` metrics, labelled with the flight's name.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+        if not leader:
+            metrics.incr('singleflight_coalesced', flight=self.name)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        metrics.incr('singleflight_calls', flight=self.name)
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
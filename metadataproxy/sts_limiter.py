@@ -0,0 +1,158 @@
+# Import python libs
+import logging
+import random
+import threading
+import time
+
+# Import third party libs
+from botocore.exceptions import ClientError
+
+# Import metadataproxy libs
+from metadataproxy import metrics
+
+log = logging.getLogger(__name__)
+
+# Error codes STS and other AWS APIs use for throttled calls.
+THROTTLING_ERROR_CODES = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException'
+])
+# How far the rate is cut on throttling, and how often at most.
+RATE_DECREASE_FACTOR = 0.5
+RATE_DECREASE_INTERVAL = 1
+# How far, as a fraction of the configured rate, each successful call raises
+# the rate back up.
+RATE_INCREASE_FRACTION = 0.02
+# Bounds, in seconds, of the backoff between retries of throttled calls.
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 5
+
+
+class StsThrottledError(Exception):
+    pass
+
+
+def is_throttling_error(e):
+    return isinstance(e, ClientError) and \
+        e.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+class StsLimiter(object):
+    """Admission control for STS calls: a token bucket that adapts to throttling.
+
+    Calls take a token from a bucket that refills at up to `rate` tokens a
+    second and holds at most `burst`. When STS throttles a call, the refill
+    rate is halved (down to `min_rate`) and the call is retried, up to
+    `retries` times, after a jittered exponential backoff; each successful
+    call then raises the rate back towards `rate`.
+
+    First fetches of credentials wait up to `max_wait` seconds for a token.
+    Refreshes of credentials that are still valid never wait, and only run
+    while the bucket is more than `refresh_reserve` full, so under pressure
+    the remaining capacity goes to containers that have no credentials yet.
+    Calls that aren't admitted raise StsThrottledError.
+
+    With a `shared_cache`, the bucket is kept in it, so that every worker
+    process on the host shares one budget. A `rate` of 0 disables the
+    limiter. Admissions are counted in the `sts_admissions` metric, by
+    priority and result, throttled calls in `sts_throttles`, and the current
+    rate is kept in the `sts_rate_limit` gauge.
+    """
+
+    def __init__(self, rate, burst, min_rate=1, retries=3, max_wait=5, refresh_reserve=0.5,
+                 shared_cache=None):
+        self._max_rate = float(rate)
+        self._burst = float(max(burst, 1))
+        self._min_rate = min(float(min_rate), self._max_rate)
+        self._retries = retries
+        self._max_wait = max_wait
+        self._refresh_reserve = self._burst * refresh_reserve
+        self._shared_cache = shared_cache
+        self._lock = threading.Lock()
+        self._state = self._initial_state()
+
+    def _initial_state(self):
+        return {
+            'tokens': self._burst,
+            'updated_at': time.time(),
+            'rate': self._max_rate,
+            'decreased_at': 0
+        }
+
+    def call(self, func, refresh=False):
+        """Run func(), an STS call, once admitted, retrying it if throttled."""
+        if not self._max_rate:
+            return func()
+        priority = 'refresh' if refresh else 'first'
+        attempt = 0
+        while True:
+            if not self._admit(refresh):
+                metrics.incr('sts_admissions', priority=priority, result='rejected')
+                raise StsThrottledError('STS call not admitted by the rate limiter')
+            metrics.incr('sts_admissions', priority=priority, result='admitted')
+            try:
+                result = func()
+            except ClientError as e:
+                if not is_throttling_error(e):
+                    raise
+                metrics.incr('sts_throttles')
+                self._update(self._decrease)
+                if attempt >= self._retries:
+                    raise StsThrottledError('STS throttled the call: {0}'.format(e))
+                delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+                log.warning('STS throttled a call; retrying in {0:.2f}s'.format(delay))
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._update(self._increase)
+            return result
+
+    def _admit(self, refresh):
+        reserve = self._refresh_reserve if refresh else 0
+        deadline = time.time() + (0 if refresh else self._max_wait)
+        while True:
+            wait = self._update(lambda state: self._take(state, reserve))
+            if not wait:
+                return True
+            if time.time() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def _take(self, state, reserve):
+        """Take a token, returning 0, or return how long until one is free."""
+        now = time.time()
+        elapsed = max(now - state['updated_at'], 0)
+        state['tokens'] = min(self._burst, state['tokens'] + elapsed * state['rate'])
+        state['updated_at'] = now
+        if state['tokens'] - 1 >= reserve:
+            state['tokens'] -= 1
+            return 0
+        return (reserve + 1 - state['tokens']) / state['rate']
+
+    def _decrease(self, state):
+        now = time.time()
+        # Calls throttled together only cut the rate once.
+        if now - state['decreased_at'] >= RATE_DECREASE_INTERVAL:
+            state['rate'] = max(self._min_rate, state['rate'] * RATE_DECREASE_FACTOR)
+            state['decreased_at'] = now
+            log.warning('STS is throttling; lowered the STS rate limit to {0:.2f}/s'.format(state['rate']))
+
+    def _increase(self, state):
+        if state['rate'] < self._max_rate:
+            state['rate'] = min(self._max_rate, state['rate'] + self._max_rate * RATE_INCREASE_FRACTION)
+
+    def _update(self, func):
+        """Run func(state) on the bucket, host-wide if it's shared."""
+        with self._lock:
+            if self._shared_cache is None:
+                result = func(self._state)
+            else:
+                with self._shared_cache.lock('bucket'):
+                    state = self._shared_cache.get('bucket') or self._initial_state()
+                    result = func(state)
+                    self._shared_cache.set('bucket', state, time.time() + 3600)
+                    self._state = state
+            metrics.set_gauge('sts_rate_limit', self._state['rate'])
+        return result
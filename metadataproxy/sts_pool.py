@@ -0,0 +1,113 @@
+# Import python libs
+import logging
+import random
+import threading
+import time
+
+# Import metadataproxy libs
+from metadataproxy import metrics
+from metadataproxy.circuit_breaker import OPEN, CircuitOpenError
+
+log = logging.getLogger(__name__)
+
+# Weight of the latest call in each endpoint's moving averages.
+EWMA_ALPHA = 0.2
+# How much an endpoint's error rate inflates its latency score: an endpoint
+# failing half its calls scores as six times slower.
+ERROR_PENALTY = 10
+
+
+class StsEndpoint(object):
+    """An STS client for one endpoint, with its circuit breaker and moving
+    averages of its call latency and error rate."""
+
+    def __init__(self, name, client, breaker):
+        self.name = name
+        self.client = client
+        self.breaker = breaker
+        self.latency = None
+        self.error_rate = 0.0
+
+    def score(self):
+        # Endpoints without a measured latency yet score best, so that each
+        # gets measured.
+        if self.latency is None:
+            return 0
+        return self.latency * (1 + ERROR_PENALTY * self.error_rate)
+
+
+class StsClientPool(object):
+    """Spread STS calls over several endpoints, such as regional endpoints.
+
+    Each call goes to the endpoint with the best score: its moving average
+    latency, inflated by its moving average error rate. Endpoints whose
+    circuit breaker is open go last. A fraction `explore` of calls go to a
+    random endpoint instead, so that an endpoint that was slow or failing is
+    measured again once it recovers. When a call fails with an error
+    `is_failure(e)` counts as the endpoint being unhealthy, such as a
+    timeout or a 5xx, it fails over to the next endpoint; other errors,
+    like AccessDenied or throttling, are raised as they are.
+
+    Calls are counted in the `sts_endpoint_calls` metric, by endpoint and
+    result, and failovers in `sts_endpoint_failovers`, by the endpoint failed
+    over to. Each endpoint's latency average is kept in the
+    `sts_endpoint_latency_seconds` gauge.
+    """
+
+    def __init__(self, endpoints, is_failure, explore=0.05):
+        self._endpoints = endpoints
+        self._is_failure = is_failure
+        self._explore = explore
+        self._lock = threading.Lock()
+
+    def assume_role(self, **kwargs):
+        return self.call('assume_role', **kwargs)
+
+    def call(self, method, **kwargs):
+        error = None
+        for i, endpoint in enumerate(self._ranked()):
+            if i:
+                log.warning('Failing over STS {0} to {1}'.format(method, endpoint.name))
+                metrics.incr('sts_endpoint_failovers', endpoint=endpoint.name)
+            start = time.time()
+            try:
+                result = endpoint.breaker.call(getattr(endpoint.client, method), **kwargs)
+            except CircuitOpenError as e:
+                metrics.incr('sts_endpoint_calls', endpoint=endpoint.name, result='rejected')
+                error = e
+                continue
+            except Exception as e:
+                if not self._is_failure(e):
+                    # The endpoint answered; the error is the caller's.
+                    self._record(endpoint, time.time() - start, False)
+                    raise
+                log.warning('STS {0} call to {1} failed: {2}'.format(method, endpoint.name, e))
+                self._record(endpoint, time.time() - start, True)
+                error = e
+                continue
+            self._record(endpoint, time.time() - start, False)
+            return result
+        raise error
+
+    def _ranked(self):
+        with self._lock:
+            ranked = sorted(
+                self._endpoints,
+                key=lambda endpoint: (endpoint.breaker.state == OPEN, endpoint.score())
+            )
+        if len(ranked) > 1 and random.random() < self._explore:
+            ranked.insert(0, ranked.pop(random.randrange(1, len(ranked))))
+        return ranked
+
+    def _record(self, endpoint, latency, failed):
+        metrics.incr('sts_endpoint_calls', endpoint=endpoint.name, result='error' if failed else 'success')
+        with self._lock:
+            endpoint.error_rate += EWMA_ALPHA * ((1.0 if failed else 0.0) - endpoint.error_rate)
+            # Failed calls, which are often timeouts, don't count towards
+            # latency; the error rate accounts for them.
+            if not failed:
+                if endpoint.latency is None:
+                    endpoint.latency = latency
+                else:
+                    endpoint.latency += EWMA_ALPHA * (latency - endpoint.latency)
+                metrics.set_gauge('sts_endpoint_latency_seconds', endpoint.latency, endpoint=endpoint.name)
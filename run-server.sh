@@ -22,6 +22,17 @@ if [ "z$WORKERS" = "z" ]; then
     WORKERS="1"
 fi
 
+if [ "z$IMDS_TOKEN_SECRET" = "z" ]; then
+    # All workers must share the secret used to sign IMDSv2 tokens.
+    IMDS_TOKEN_SECRET=$(head -c 32 /dev/urandom | base64)
+    export IMDS_TOKEN_SECRET
+fi
+
 export PYTHONUNBUFFERED="true"
 
+if [ "$SERVER_MODE" = "asyncio" ]; then
+    # The aiohttp worker needs an access log format in aiohttp's syntax.
+    exec /usr/local/bin/gunicorn metadataproxy.aio:make_app -c $GUNICORN_CONFIG --log-level $LEVEL --workers=$WORKERS -k aiohttp.GunicornWebWorker --access-logformat '%t "%r" %s %b %Tf "%{X-Forwarded-For}i" "%a"' -b $HOST:$PORT --access-logfile - --error-logfile - --log-file -
+fi
+
 /usr/local/bin/gunicorn metadataproxy:app -c $GUNICORN_CONFIG --log-level $LEVEL --workers=$WORKERS -k gevent -b $HOST:$PORT --access-logfile - --error-logfile - --log-file -
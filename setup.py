@@ -21,15 +21,20 @@ with open('requirements_wsgi.txt') as f:
     reqs_wsgi = f.read().splitlines()
     reqs_wsgi = [r for r in reqs_wsgi if not r.startswith('#') and r]
 
+with open('requirements_aio.txt') as f:
+    reqs_aio = f.read().splitlines()
+    reqs_aio = [r for r in reqs_aio if not r.startswith('#') and r]
+
 reqs = reqs_base + reqs_wsgi
 
 setup(
     name="metadataproxy",
-    version="2.2.0",
+    version="2.3.0",
     packages=find_packages(exclude=["test*"]),
     include_package_data=True,
     zip_safe=False,
     install_requires=reqs,
+    extras_require={'aio': reqs_aio},
     author="Ryan Lane",
     author_email="rlane@lyft.com",
     description=("A proxy for AWS's metadata service that gives out"